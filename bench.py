@@ -0,0 +1,416 @@
+"""
+===============================================================================>
+
+ベンチマーク(シート→DBのパイプライン・ロード方式・行変換)
+
+===============================================================================>
+"""
+import random
+import string
+import json
+import sys
+import os
+import time
+import resource
+import multiprocessing
+import subprocess
+from datetime import datetime as dt
+import db
+import transform
+import fakesheet
+import main
+
+BENCH_TABLE = {
+    'name': 'bench_load_t',
+    'engine': 'InnoDB',
+    'comment': 'bench',
+    'primary_key': 'id',
+    'columns': [
+        {'name': 'id', 'type': 'int(11)', 'allow_null': False, 'default': '', 'option': 'AUTO_INCREMENT'},
+        {'name': 'name', 'type': 'varchar(255)', 'allow_null': True, 'default': 'NULL'},
+        {'name': 'email', 'type': 'TEXT', 'allow_null': True, 'default': 'NULL'},
+        {'name': 'created', 'type': 'DATETIME', 'allow_null': True, 'default': 'NULL'},
+    ]
+}
+
+def make_rows(n):
+    u"""
+    name, email, created の合成データを作成
+    """
+    now = dt.today().strftime("%Y-%m-%d %H:%M:%S")
+    rows = []
+    for i in range(n):
+        name = ''.join(random.choices(string.ascii_letters, k=12))
+        rows.append([name, name.lower() + '@example.com', now])
+    return rows
+
+def bench_load(maria_db, mode, rows):
+    maria_db.load_mode = mode
+    maria_db.truncate_table(BENCH_TABLE['name'])
+    start = time.perf_counter()
+    msg = maria_db.load(BENCH_TABLE['name'], ['name', 'email', 'created'], rows)
+    sec = time.perf_counter() - start
+    return {'mode': mode, 'rows': len(rows), 'sec': round(sec, 3), 'rows_per_sec': round(len(rows) / sec, 1), 'result': msg}
+
+def make_sheet_rows(n):
+    u"""
+    シートの生データ(文字列の二次元リスト)を作成。id(数値), name, email, created(日時)
+    """
+    rows = []
+    for i in range(n):
+        name = ''.join(random.choices(string.ascii_letters, k=12))
+        rows.append([str(i) if i % 50 else '', name, name.lower() + '@example.com', '2024/01/{:02d} 10:{:02d}:00'.format(i % 28 + 1, i % 60)])
+    return rows
+
+def bench_transform(n):
+    u"""
+    行毎のdict/list組み立てと列単位の変換(transform)を比較
+    """
+    rows = make_sheet_rows(n)
+    pair = [{'idx': str(idx), 'col': col['name']} for idx, col in enumerate(BENCH_TABLE['columns'])]
+    now = dt.today().strftime("%Y-%m-%d %H:%M:%S")
+    results = []
+    # 行毎の変換(従来のget_data・insert_data相当に同じ型変換を加えたもの)
+    start = time.perf_counter()
+    rec_list = []
+    for row in rows:
+        dict = {}
+        for info in pair:
+            dict[info['col']] = row[int(info['idx'])]
+        rec_list.append(dict)
+    insert_list = []
+    for d in rec_list:
+        list = []
+        list.append(int(d['id']) if d['id'] else None)
+        list.append(d['name'])
+        list.append(d['email'])
+        list.append(dt.strptime(d['created'], '%Y/%m/%d %H:%M:%S').strftime("%Y-%m-%d %H:%M:%S") if d['created'] else None)
+        list.append(now)
+        insert_list.append(list)
+    results.append({'mode': 'row', 'rows': n, 'sec': round(time.perf_counter() - start, 3)})
+    # 列単位の変換(型変換込み)
+    start = time.perf_counter()
+    df = transform.to_frame(rows, pair, BENCH_TABLE)
+    insert_list = transform.to_rows(df.assign(created_at=now))
+    results.append({'mode': 'columnar', 'rows': n, 'sec': round(time.perf_counter() - start, 3)})
+    for res in results:
+        res['rows_per_sec'] = round(n / res['sec'], 1) if res['sec'] > 0 else 0.0
+    return results
+
+
+# 合成スキーマで指定できる型
+SYNTHETIC_TYPES = {
+    'int': 'int(11)',
+    'varchar': 'varchar(255)',
+    'text': 'TEXT',
+    'decimal': 'decimal(10,2)',
+    'date': 'DATE',
+    'datetime': 'DATETIME',
+}
+
+# パイプラインのロード方式(targetごと)
+STRATEGIES = {
+    'sqlite': [
+        {'name': 'sqlite-python', 'transform': 'python', 'load': {}},
+        {'name': 'sqlite-columnar', 'transform': 'columnar', 'load': {}},
+        {'name': 'sqlite-defer-index', 'transform': 'columnar', 'load': {}, 'table': {'defer_index': True}},
+    ],
+    'mariadb': [
+        {'name': 'mariadb-insert', 'transform': 'columnar', 'load': {'mode': 'insert', 'sync': 'full'}},
+        {'name': 'mariadb-infile', 'transform': 'columnar', 'load': {'mode': 'infile', 'sync': 'full'}},
+        {'name': 'mariadb-swap', 'transform': 'columnar', 'load': {'mode': 'insert', 'sync': 'swap'}},
+        {'name': 'mariadb-defer-index', 'transform': 'columnar', 'load': {'mode': 'insert', 'sync': 'full'}, 'table': {'defer_index': True}},
+        {'name': 'mariadb-parallel', 'transform': 'columnar', 'load': {'mode': 'insert', 'sync': 'full', 'parallel': 4}},
+    ],
+}
+
+def make_schema(columns=None):
+    u"""
+    ベンチマーク用のtable・spreadsheet定義を返す
+    columns('int,varchar,datetime'のような型の並び)の指定がなければconfig.jsonのtable・spreadsheet.pairを使う
+    columns指定時はTEXT以外の列すべてにインデックスを作成する
+    """
+    if not columns:
+        return main.get_config()['table'], dict(main.get_config()['spreadsheet'], id='bench', name='bench')
+    table = {
+        'name': 'bench_pipeline_t',
+        'engine': 'InnoDB',
+        'primary_key': 'id',
+        'columns': [{'name': 'id', 'type': 'int(11)', 'null': False, 'default': '', 'option': 'AUTO_INCREMENT'}],
+    }
+    pair = []
+    for idx, col_type in enumerate(columns.split(',')):
+        name = 'c{}_{}'.format(idx, col_type)
+        table['columns'].append({'name': name, 'type': SYNTHETIC_TYPES[col_type], 'null': True, 'default': 'NULL'})
+        pair.append({'idx': str(idx), 'col': name})
+    table['columns'].append({'name': 'created', 'type': 'DATETIME', 'null': True, 'default': 'NULL'})
+    table['index'] = [info['col'] for info in pair if not info['col'].endswith('_text')]
+    return table, {'id': 'bench', 'name': 'bench', 'pair': pair, 'key': [pair[0]['col']]}
+
+def make_cell(col_type, i):
+    if 'int' in col_type:
+        return str(random.randint(0, 1000000))
+    if any([t in col_type for t in ('decimal', 'float', 'double')]):
+        return '{:.2f}'.format(random.random() * 10000)
+    if 'datetime' in col_type or 'timestamp' in col_type:
+        return '2024/{:02d}/{:02d} {:02d}:{:02d}:00'.format(i % 12 + 1, i % 28 + 1, i % 24, i % 60)
+    if 'date' in col_type:
+        return '2024-{:02d}-{:02d}'.format(i % 12 + 1, i % 28 + 1)
+    return ''.join(random.choices(string.ascii_letters, k=16))
+
+def make_sheet(table, spreadsheet, n, seed=0):
+    u"""
+    spreadsheet.pairの列位置にテーブル定義の型に合った値を入れた合成シート(ヘッダー行付き)を作成
+    """
+    random.seed(seed)
+    col_types = transform.get_column_types(table)
+    width = max([int(info['idx']) for info in spreadsheet['pair']]) + 1
+    header = [''] * width
+    for info in spreadsheet['pair']:
+        header[int(info['idx'])] = info['col']
+    rows = [header]
+    for i in range(n):
+        row = [''] * width
+        for info in spreadsheet['pair']:
+            row[int(info['idx'])] = make_cell(col_types.get(info['col'], 'text'), i)
+        rows.append(row)
+    return rows
+
+def peak_rss_mb():
+    # Linuxのru_maxrssはKB単位
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def timed_iter(iterable, stats, key):
+    u"""
+    iterableから次の要素を取り出すのにかかった時間をstats[key]に加算する
+    """
+    it = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            stats[key] += time.perf_counter() - start
+            return
+        stats[key] += time.perf_counter() - start
+        yield item
+
+def timed_call(func, stats, key):
+    def call(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats[key] += time.perf_counter() - start
+    return call
+
+def run_pipeline(spec):
+    u"""
+    1つのロード方式で 合成シート→get_data(fakesheet)→insert_data を実行し、段階毎の時間・ピークRSSを返す
+    ピークRSSを方式ごとに測るため別プロセスで実行する
+    """
+    table, spreadsheet = make_schema(spec['columns'])
+    table = dict(table, **spec.get('table', {}))
+    client = fakesheet.FakeClient({spreadsheet['id']: {spreadsheet['name']: make_sheet(table, spreadsheet, spec['rows'])}})
+    rss_sheet = peak_rss_mb()
+    if spec['target'] == 'sqlite':
+        target = db.SQLite({'db_file': spec['sqlite_file'], 'name': table['name']})
+    else:
+        target = db.MariaDB(config=spec['mariadb'])
+    target.set_load_config(spec['load'])
+    target.drop_table(target.with_scheme(table['name']))
+    job = {
+        'name': spec['name'],
+        'table': table,
+        'spreadsheet': dict(spreadsheet, transform=spec['transform'], batch_rows=spec['batch_rows']),
+        'load': spec['load'],
+    }
+    sheet = main.SpreadSheet('localhost', False, True, client=client, job=job, db_obj=target)
+    stats = {'fetch': 0.0, 'transform': 0.0, 'load': 0.0}
+    iter_rows = sheet.iter_rows
+    sheet.iter_rows = lambda *args: timed_iter(iter_rows(*args), stats, 'fetch')
+    target.load = timed_call(target.load, stats, 'load')
+    start = time.perf_counter()
+    rows = sheet.insert_batches(timed_iter(sheet.iter_batches(), stats, 'transform'), spec.get('db_name', 'bench'))
+    sec = time.perf_counter() - start
+    # transformの計測値には取得(fetch)の時間が含まれる
+    stats['transform'] -= stats['fetch']
+    target.drop_table(target.with_scheme(table['name']))
+    target.close()
+    return {
+        'name': spec['name'],
+        'target': spec['target'],
+        'rows': rows,
+        'sec': round(sec, 3),
+        'rows_per_sec': round(rows / sec, 1) if sec > 0 else 0.0,
+        'stages': {k: round(v, 3) for k, v in stats.items()},
+        'rss_sheet_mb': rss_sheet,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def bench_pipeline(args):
+    specs = []
+    targets = ['sqlite'] + (['mariadb'] if args.mariadb else [])
+    for target in targets:
+        for strategy in STRATEGIES[target]:
+            if args.strategy and strategy['name'] not in args.strategy:
+                continue
+            specs.append(dict(
+                strategy,
+                target=target,
+                rows=args.rows,
+                columns=args.columns,
+                batch_rows=args.batch_rows,
+                sqlite_file=args.sqlite_file,
+                db_name=args.db,
+                mariadb={'host': args.host, 'port': args.port, 'db': args.db, 'user': args.user, 'pass': args.password},
+            ))
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    for spec in specs:
+        with ctx.Pool(1) as pool:
+            results.append(pool.apply(run_pipeline, (spec,)))
+    for path in (args.sqlite_file, args.sqlite_file + '-wal', args.sqlite_file + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+    return results
+
+def check_regression(results, baseline_file, tolerance):
+    u"""
+    前回の結果(baseline_file)よりrows/secがtolerance以上低下した方式を返す
+    """
+    with open(baseline_file) as f:
+        baseline = {res['name']: res for res in json.load(f)}
+    regressions = []
+    for res in results:
+        base = baseline.get(res['name'])
+        if base and res['rows_per_sec'] < base['rows_per_sec'] * (1 - tolerance):
+            regressions.append({'name': res['name'], 'rows_per_sec': res['rows_per_sec'], 'baseline': base['rows_per_sec']})
+    return regressions
+
+# 起動時(import main・--help)に読み込まれてはいけない重いモジュール
+HEAVY_MODULES = ('pandas', 'sqlalchemy', 'pymysql', 'gspread', 'oauth2client')
+
+def parse_importtime(stderr):
+    u"""
+    -X importtimeの出力から最上位でimportしたモジュール・全モジュールそれぞれの 名前→累積時間(マイクロ秒) を返す
+    """
+    top = {}
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative)
+        # 入れ子のimportは名前の前の空白で表される
+        if not name[1:].startswith(' '):
+            top[name.strip()] = int(cumulative)
+    return top, modules
+
+def run_importtime(argv):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + argv, cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    top, modules = parse_importtime(proc.stderr)
+    return {'returncode': proc.returncode, 'wall_ms': round(wall * 1000, 1), 'top': top, 'modules': modules}
+
+def bench_imports(top_n=5):
+    u"""
+    import main・main.py --helpのimport時間を計測し、重いモジュールを読み込んでいないか確認する
+    インタープリタ起動時の分(python -c pass)は差し引く
+    """
+    base = run_importtime(['-c', 'pass'])
+    results = []
+    for name, argv in (('import main', ['-c', 'import main']), ('main.py --help', ['main.py', '--help'])):
+        res = run_importtime(argv)
+        top = {module: us for module, us in res['top'].items() if module not in base['top']}
+        slowest = {module: us for module, us in res['modules'].items() if module not in base['modules'] and module != 'main'}
+        results.append({
+            'name': name,
+            'returncode': res['returncode'],
+            'import_ms': round(sum(top.values()) / 1000, 1),
+            'wall_ms': round(res['wall_ms'] - base['wall_ms'], 1),
+            'heavy': sorted(set([module.split('.')[0] for module in res['modules']]) & set(HEAVY_MODULES)),
+            'slowest': [{'module': module, 'ms': round(us / 1000, 1)} for module, us in sorted(slowest.items(), key=lambda item: -item[1])[:top_n]],
+        })
+    return results
+
+def write_results(results, output):
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    import argparse
+    # コマンドライン引数設定
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command')
+    def add_db_args(p):
+        p.add_argument("--host", help="optional. DBホスト.", default='localhost')
+        p.add_argument("--port", help="optional. DBポート.", type=int, default=3306)
+        p.add_argument("--user", help="optional. DBユーザー.", default='root')
+        p.add_argument("--password", help="optional. DBパスワード.", default='root')
+        p.add_argument("--db", help="optional. DB名.", default='test_db')
+    p_pipeline = sub.add_parser('pipeline', help='合成シート→get_data→insert_dataをロード方式ごとに計測')
+    p_pipeline.add_argument("--rows", help="optional. 行数.", type=int, default=100000)
+    p_pipeline.add_argument("--columns", help="optional. 列の型の並び(例: int,varchar,text,datetime). 未指定はconfig.jsonの定義.")
+    p_pipeline.add_argument("--batch-rows", help="optional. シート取得の行数単位.", type=int, default=5000)
+    p_pipeline.add_argument("--strategy", help="optional. 計測するロード方式(複数指定可).", action='append')
+    p_pipeline.add_argument("--sqlite-file", help="optional. SQLiteのファイル.", default='bench.db')
+    p_pipeline.add_argument("--mariadb", help="optional. MariaDBでも計測.", action="store_true")
+    p_pipeline.add_argument("--baseline", help="optional. 比較する前回の結果JSON.")
+    p_pipeline.add_argument("--tolerance", help="optional. 許容する低下率.", type=float, default=0.2)
+    p_pipeline.add_argument("--output", help="optional. 結果JSONの出力先.", default='bench_results.json')
+    add_db_args(p_pipeline)
+    p_load = sub.add_parser('load', help='MariaDBのロード方式(insert/infile)を比較')
+    p_load.add_argument("--rows", help="optional. 行数.", type=int, default=100000)
+    p_load.add_argument("--output", help="optional. 結果JSONの出力先.")
+    add_db_args(p_load)
+    p_transform = sub.add_parser('transform', help='DBを使わず行変換のみ計測')
+    p_transform.add_argument("--rows", help="optional. 行数.", type=int, default=100000)
+    p_transform.add_argument("--output", help="optional. 結果JSONの出力先.")
+    p_imports = sub.add_parser('imports', help='起動時のimport時間を計測(重いモジュールを読み込んでいれば異常終了)')
+    p_imports.add_argument("--max-ms", help="optional. 許容するimport時間(ミリ秒).", type=float)
+    p_imports.add_argument("--top", help="optional. 表示する遅いモジュールの数.", type=int, default=5)
+    p_imports.add_argument("--output", help="optional. 結果JSONの出力先.")
+    args = parser.parse_args()
+    if args.command == 'pipeline':
+        results = bench_pipeline(args)
+        for res in results:
+            print('{name}: {rows} rows, {sec} sec, {rows_per_sec} rows/sec, peak RSS {peak_rss_mb} MB (sheet {rss_sheet_mb} MB), stages {stages}'.format(**res))
+        write_results(results, args.output)
+        if args.baseline:
+            regressions = check_regression(results, args.baseline, args.tolerance)
+            for reg in regressions:
+                print('REGRESSION {name}: {rows_per_sec} rows/sec (baseline {baseline})'.format(**reg))
+            if regressions:
+                sys.exit(1)
+    elif args.command == 'load':
+        maria_db = db.MariaDB(config={'host': args.host, 'port': args.port, 'db': args.db, 'user': args.user, 'pass': args.password})
+        maria_db.create_table(BENCH_TABLE)
+        rows = make_rows(args.rows)
+        results = [bench_load(maria_db, mode, rows) for mode in ('insert', 'infile')]
+        maria_db.drop_table(maria_db.with_scheme(BENCH_TABLE['name']))
+        for res in results:
+            print('{mode}: {rows} rows, {sec} sec, {rows_per_sec} rows/sec ({result})'.format(**res))
+        write_results(results, args.output)
+    elif args.command == 'transform':
+        results = bench_transform(args.rows)
+        for res in results:
+            print('{mode}: {rows} rows, {sec} sec, {rows_per_sec} rows/sec'.format(**res))
+        write_results(results, args.output)
+    elif args.command == 'imports':
+        results = bench_imports(args.top)
+        failed = False
+        for res in results:
+            print('{name}: import {import_ms} ms, wall {wall_ms} ms (over bare interpreter), slowest {slowest}'.format(**res))
+            if res['returncode'] != 0 or res['heavy'] or (args.max_ms and res['import_ms'] > args.max_ms):
+                print('FAILED {name}: returncode {returncode}, heavy modules {heavy}'.format(**res))
+                failed = True
+        write_results(results, args.output)
+        if failed:
+            sys.exit(1)
+    else:
+        parser.print_help()
@@ -5,13 +5,25 @@ DB接続ライブラリ
 
 ===============================================================================>
 """
-import pymysql.cursors
-import pandas as pd
-import sqlalchemy as sa
+# pymysql・pandas・sqlalchemyは読み込みに時間がかかるため、使う処理の中でimportする
 from pprint import pprint
 import traceback
 import sys
+import time
+import json
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from datetime import datetime as dt
+import tempfile
 import sqlite3
+import re
+import zlib
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from myutil import slice_list, iter_chunks
+import metrics
 
 
 def get_db_obj(db_type=None, host='localhost', config=None):
@@ -25,26 +37,34 @@ def get_db_obj(db_type=None, host='localhost', config=None):
         return AnalyticsDB(db_host=host)
     return None
 
-def get_sql_for_create_table(table):
+def is_allow_null(col):
+    # 列のNULL許可は allow_null / null のどちらでも指定可
+    return col['allow_null'] if 'allow_null' in col.keys() else col['null']
+
+def get_column_definition(col):
+    return "`{}` {} {} {}{}{}".format(
+        col['name'],
+        col['type'],
+        'NULL' if is_allow_null(col) else 'NOT NULL',
+        'DEFAULT ' + col['default'] if col['default'] else '',
+        col['option'] if 'option' in col.keys() else '',
+        ' COMMENT "{}"'.format(col['comment']) if 'comment' in col.keys() else ''
+    )
+
+def get_sql_for_create_table(table, with_index=True):
     sql_base = "CREATE TABLE IF NOT EXISTS `{}` ({}) COMMENT='{}' ENGINE={};"
-    col_list = []
-    for col in table['columns']:
-        col_list.append(
-            "`{}` {} {} {}{}{}".format(
-                col['name'],
-                col['type'],
-                'NULL' if col['allow_null'] else 'NOT NULL',
-                'DEFAULT ' + col['default'] if col['default'] else '',
-                col['option'] if 'option' in col.keys() else '',
-                ' COMMENT "{}"'.format(col['comment']) if 'comment' in col.keys() else ''
-            )
-        )
+    col_list = [get_column_definition(col) for col in table['columns']]
     sql_part_col = ",\n".join(col_list)
     # 主キー設定
     if table['primary_key']:
         sql_part_col = sql_part_col + ", PRIMARY KEY (`{}`)".format(table['primary_key'])
-    # インデックスキー設定
-    if 'index' in table.keys():
+    # ユニークキー設定
+    if 'unique' in table.keys():
+        sql_part_col = sql_part_col + ", UNIQUE KEY `uk_{}` ({})".format(
+            '_'.join(table['unique']),
+            ', '.join(['`{}`'.format(col) for col in table['unique']]))
+    # インデックスキー設定(with_index=Falseの場合はget_sql_for_add_indexで後から作成する)
+    if with_index and table.get('index'):
         index_str_list = []
         for index_col in table['index']:
             index_str_list.append('INDEX `{}` (`{}`)'.format(index_col, index_col))
@@ -52,23 +72,410 @@ def get_sql_for_create_table(table):
     sql = sql_base.format(
         table['name'],
         sql_part_col,
-        table['comment'],
+        table.get('comment', ''),
         table['engine'])
     return sql
 
+def get_sql_for_add_index(table):
+    u"""
+    indexの全インデックスを1回のALTER TABLEで作成するSQL
+    """
+    if not table.get('index'):
+        return None
+    index_str_list = ['ADD INDEX `{}` (`{}`)'.format(index_col, index_col) for index_col in table['index']]
+    return "ALTER TABLE `{}` {};".format(table['name'], ', '.join(index_str_list))
+
+def normalize_type(col_type):
+    u"""
+    比較用に型を正規化する。整数型の表示幅(int(11)など)はサーバーによって有無が異なるため除く
+    """
+    col_type = re.sub(r'\s+', ' ', col_type.strip().lower())
+    col_type = re.sub(r'\binteger\b', 'int', col_type)
+    return re.sub(r'\b(tinyint|smallint|mediumint|int|bigint)\s*\(\d+\)', r'\1', col_type)
+
+def get_schema_changes(table, columns, indexes, with_index=True):
+    u"""
+    テーブル定義とinformation_schemaの列(COLUMN_NAME・COLUMN_TYPE・IS_NULLABLE)・インデックス(名前→列のリスト)を比較し、
+    ALTER TABLEの句を返す。定義にない列・インデックスはデータ保護のため削除しない
+    """
+    current = {col['COLUMN_NAME'].lower(): col for col in columns}
+    changes = {'add_column': [], 'modify_column': [], 'add_index': [], 'extra_column': []}
+    prev_col = None
+    for col in table['columns']:
+        cur = current.get(col['name'].lower())
+        if cur is None:
+            changes['add_column'].append("ADD COLUMN {}{}".format(
+                get_column_definition(col), ' AFTER `{}`'.format(prev_col) if prev_col else ' FIRST'))
+        elif (normalize_type(cur['COLUMN_TYPE']) != normalize_type(col['type'])
+                or (cur['IS_NULLABLE'] == 'YES') != bool(is_allow_null(col))):
+            changes['modify_column'].append("MODIFY COLUMN " + get_column_definition(col))
+        prev_col = col['name']
+    names = [col['name'].lower() for col in table['columns']]
+    changes['extra_column'] = [col['COLUMN_NAME'] for col in columns if col['COLUMN_NAME'].lower() not in names]
+    if 'unique' in table.keys():
+        name = 'uk_' + '_'.join(table['unique'])
+        if name not in indexes:
+            changes['add_index'].append("ADD UNIQUE KEY `{}` ({})".format(name, ', '.join(['`{}`'.format(col) for col in table['unique']])))
+    if with_index:
+        for index_col in table.get('index') or []:
+            if index_col not in indexes:
+                changes['add_index'].append('ADD INDEX `{}` (`{}`)'.format(index_col, index_col))
+    return changes
+
+def get_algorithms(changes):
+    u"""
+    変更内容に応じて試すALGORITHMの順番を返す(None=サーバーに任せる。テーブル再構築になる場合がある)
+    列の追加だけならINSTANT、インデックス追加・列の変更はINPLACE(LOCK=NONE)を優先する
+    """
+    if changes['modify_column']:
+        return ['INPLACE', None]
+    if changes['add_index']:
+        return ['INPLACE', None]
+    return ['INSTANT', 'INPLACE', None]
+
+def get_sql_for_alter_table(table_name, clauses, algorithm=None):
+    sql = "ALTER TABLE `{}` {}".format(table_name, ', '.join(clauses))
+    if algorithm == 'INPLACE':
+        sql += ", ALGORITHM=INPLACE, LOCK=NONE"
+    elif algorithm:
+        sql += ", ALGORITHM=" + algorithm
+    return sql + ";"
+
+def get_sql_for_drop_index(table_name, index_names):
+    u"""
+    index_namesのインデックスを1回のALTER TABLEで削除するSQL
+    """
+    if not index_names:
+        return None
+    return "ALTER TABLE `{}` {};".format(table_name, ', '.join(['DROP INDEX `{}`'.format(name) for name in index_names]))
+
+# インデックスを後から作成するロードで緩めるセッション変数
+RELAXED_CHECKS = {'unique_checks': 0, 'foreign_key_checks': 0}
+
+# 指定したALGORITHM・LOCKでは実行できない(またはALGORITHM=INSTANTに未対応の)場合のエラー
+ALTER_ALGORITHM_ERRORS = (1064, 1800, 1845, 1846)
+
+class PoolTimeout(Exception):
+    pass
+
+"""
+pymysqlコネクションプール
+"""
+class ConnectionPool:
+
+    def __init__(self, connect_args, size=5, recycle=3600, ping=True, timeout=30):
+        self.connect_args = connect_args
+        self.size = size
+        self.recycle = recycle
+        self.ping = ping
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.created = {}
+        # 貸し出し中の接続数
+        self.in_use = 0
+        self.lock = threading.Lock()
+
+    def new_connection(self):
+        import pymysql
+        conn = pymysql.connect(**self.connect_args)
+        self.created[id(conn)] = time.time()
+        return conn
+
+    def discard(self, conn):
+        self.created.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolTimeout('no free connection in {} sec (pool size: {})'.format(self.timeout, self.size))
+        with self.lock:
+            self.in_use += 1
+        try:
+            while True:
+                try:
+                    conn = self.idle.get_nowait()
+                except queue.Empty:
+                    return self.new_connection()
+                # recycle秒を超えた接続・切断済みの接続は作り直す
+                if self.recycle and time.time() - self.created.get(id(conn), 0) > self.recycle:
+                    self.discard(conn)
+                    continue
+                if self.ping:
+                    try:
+                        conn.ping(reconnect=False)
+                    except Exception:
+                        self.discard(conn)
+                        continue
+                return conn
+        except BaseException:
+            with self.lock:
+                self.in_use -= 1
+            self.slots.release()
+            raise
+
+    def available(self):
+        u"""
+        待たずに借りられる接続数
+        """
+        with self.lock:
+            return self.size - self.in_use
+
+    def release(self, conn):
+        u"""
+        接続をプールへ返却する。autocommitでないため、参照だけの場合も含め常にROLLBACKしてトランザクション(スナップショット・メタデータロック)を終わらせる
+        """
+        try:
+            conn.rollback()
+            self.idle.put(conn)
+        except Exception:
+            self.discard(conn)
+        finally:
+            with self.lock:
+                self.in_use -= 1
+            self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self.discard(self.idle.get_nowait())
+            except queue.Empty:
+                break
+
+# 接続先ごとのコネクションプール・SQLAlchemyエンジン(サブクラス・インスタンス間で共有)
+POOLS = {}
+ENGINES = {}
+POOL_LOCK = threading.Lock()
+
+def get_pool(connect_args, size=5, recycle=3600, ping=True, timeout=30):
+    key = tuple(sorted((k, str(v)) for k, v in connect_args.items()))
+    with POOL_LOCK:
+        if key not in POOLS:
+            POOLS[key] = ConnectionPool(connect_args, size, recycle, ping, timeout)
+        return POOLS[key]
+
+def get_engine(url, size=5, recycle=3600, ping=True):
+    with POOL_LOCK:
+        if url not in ENGINES:
+            import sqlalchemy as sa
+            ENGINES[url] = sa.create_engine(url, echo=False, pool_size=size, pool_recycle=recycle, pool_pre_ping=ping)
+        return ENGINES[url]
+
+def close_pools():
+    with POOL_LOCK:
+        for pool in POOLS.values():
+            pool.close()
+        POOLS.clear()
+        for engine in ENGINES.values():
+            engine.dispose()
+        ENGINES.clear()
+
+# LOAD DATA LOCAL INFILEが無効な場合のエラーコード
+LOCAL_INFILE_ERRORS = (1148, 2068, 3948)
+
+def escape_tsv(value):
+    u"""
+    LOAD DATAのデフォルト形式(ESCAPED BY '\\')に合わせて値をエスケープする
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return (str(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+        .replace('\0', '\\0'))
+
+def get_recoverable_errors():
+    u"""
+    二分割による切り分け対象とする行単位のエラー
+    """
+    import pymysql
+    return (pymysql.err.IntegrityError, pymysql.err.DataError)
+
+def get_quarantine_table(table):
+    u"""
+    不正行の隔離テーブル定義
+    """
+    return {
+        'name': table + '__rejected',
+        'engine': 'InnoDB',
+        'comment': 'rejected rows of ' + table,
+        'primary_key': 'id',
+        'columns': [
+            {'name': 'id', 'type': 'int(11)', 'allow_null': False, 'default': '', 'option': 'AUTO_INCREMENT'},
+            {'name': 'row_data', 'type': 'TEXT', 'allow_null': True, 'default': 'NULL'},
+            {'name': 'error', 'type': 'TEXT', 'allow_null': True, 'default': 'NULL'},
+            {'name': 'created', 'type': 'DATETIME', 'allow_null': True, 'default': 'NULL'},
+        ]
+    }
+
+def get_sync_state_table(table):
+    u"""
+    差分同期用の状態テーブル定義(キー値のハッシュ毎に行のハッシュを保持)
+    """
+    return {
+        'name': table + '__sync_state',
+        'engine': 'InnoDB',
+        'comment': 'sync state of ' + table,
+        'primary_key': 'row_key',
+        'columns': [
+            {'name': 'row_key', 'type': 'char(40)', 'allow_null': False, 'default': ''},
+            {'name': 'key_data', 'type': 'TEXT', 'allow_null': True, 'default': 'NULL'},
+            {'name': 'row_hash', 'type': 'char(40)', 'allow_null': True, 'default': 'NULL'},
+        ]
+    }
+
+def iter_keys(value_list, key_idx):
+    u"""
+    行毎のキー列の値をtupleで返す(rowstore.RowStoreはキー列だけを読む)
+    """
+    columns = getattr(value_list, 'columns', None)
+    if columns is not None:
+        return zip(*[columns[idx] for idx in key_idx])
+    return (tuple([row[idx] for idx in key_idx]) for row in value_list)
+
+def get_sort_key(key):
+    # NULLは先頭、数値とそれ以外の型が混ざっても比較できるようにする
+    return tuple([(0,) if v is None else (1, '' if isinstance(v, (int, float)) else type(v).__name__, v) for v in key])
+
+def get_partitions(value_list, key_idx, parallel, method='hash'):
+    u"""
+    行をparallel個に分け、パーティション毎の行番号のリストを返す
+    キー列の値が同じ行は同じパーティションへ元の順で入る(hash: キーのCRC32 / range: キーの範囲)
+    キー列がなければ連続する行で等分する
+    """
+    total = len(value_list)
+    if not key_idx:
+        size = -(-total // parallel) if total else 1
+        return [list(range(start, min(start + size, total))) for start in range(0, total, size)]
+    partitions = [[] for i in range(parallel)]
+    if method == 'range':
+        keys = list(iter_keys(value_list, key_idx))
+        distinct = sorted(set(keys), key=get_sort_key)
+        bounds = [get_sort_key(distinct[len(distinct) * k // parallel]) for k in range(1, parallel)]
+        for i, key in enumerate(keys):
+            partitions[bisect_right(bounds, get_sort_key(key))].append(i)
+    else:
+        for i, key in enumerate(iter_keys(value_list, key_idx)):
+            partitions[zlib.crc32(repr(key).encode('utf-8')) % parallel].append(i)
+    return [indexes for indexes in partitions if indexes]
+
+def take_rows(value_list, indexes):
+    if hasattr(value_list, 'take'):
+        return value_list.take(indexes)
+    return [value_list[i] for i in indexes]
+
+# キー重複時の扱い(update: ON DUPLICATE KEY UPDATE / ignore: INSERT IGNORE / replace: REPLACE)
+MERGE_STRATEGIES = ('update', 'ignore', 'replace')
+
+def get_info(cursor):
+    u"""
+    直前の複数行INSERTの情報(Records: N  Duplicates: D  Warnings: W)を返す。ない場合はNone
+    """
+    message = getattr(getattr(cursor, '_result', None), 'message', None)
+    if isinstance(message, bytes):
+        message = message.decode('utf-8', 'replace')
+    match = re.search(r'Records:\s*(\d+)\s+Duplicates:\s*(\d+)', message or '')
+    if not match:
+        return None
+    return {'records': int(match.group(1)), 'duplicates': int(match.group(2))}
+
+def count_changes(strategy, rows, affected, info=None):
+    u"""
+    1文の影響行数(追加1・更新2・変更なし0として数えられる)と情報から、追加・更新・変更なしの件数を返す
+    pymysqlはCLIENT_FOUND_ROWSを指定しないため、Duplicatesは実際に更新した行だけを数える
+    情報がなければ、更新がある場合は変更なしの行がないものとして数える
+    """
+    if strategy == 'update':
+        updated = info['duplicates'] if info else max(0, affected - rows)
+        inserted = affected - updated * 2
+        return {'inserted': inserted, 'updated': updated, 'unchanged': rows - inserted - updated}
+    if strategy == 'replace':
+        # 重複した行は削除してから追加されるため2行と数えられる
+        duplicates = info['duplicates'] if info else affected - rows
+        updated = min(rows, max(0, duplicates))
+        return {'inserted': rows - updated, 'updated': updated, 'unchanged': 0}
+    # ignore: 無視された行は数えられない
+    return {'inserted': affected, 'updated': 0, 'unchanged': rows - affected}
+
+class BulkInsertError(Exception):
+    u"""
+    バルクロード失敗。rowsには失敗前に処理済みの件数が入る
+    """
+    def __init__(self, rows, error):
+        super().__init__('bulk insert failed after {} rows: {}'.format(rows, error))
+        self.rows = rows
+        self.error = error
+
+class LoadError(Exception):
+    u"""
+    ロード失敗(単一INSERTへの切り替え後も全行をロードできなかった)。rowsにはロードできた件数が入る
+    """
+    def __init__(self, table, rows, total, error):
+        super().__init__('load into {} failed ({}/{} rows): {}'.format(table, rows, total, error))
+        self.table = table
+        self.rows = rows
+        self.total = total
+        self.error = error
+
+def check_parallel_result(table, result):
+    u"""
+    parallel_insertの結果に、ロードしきれなかったパーティションがあればLoadErrorを送出する
+    """
+    failed = [error for error in result['errors'] if error['loaded'] < error['rows']]
+    if failed:
+        raise LoadError(table, result['rows'], result['rows'] + sum([error['rows'] - error['loaded'] for error in failed]),
+            '; '.join(['partition {partition}: {error}'.format(**error) for error in failed]))
+    return result
+
 """
 MariaDB操作用クラス
 """
 class MariaDB:
 
+    # バルクロード設定(1文あたりの最大行数・最大バイト数・何文ごとにCOMMITするか)
+    batch_rows = 1000
+    batch_bytes = 1024 * 1024
+    commit_batches = 10
+    # ロード方式(insert: 複数行INSERT / infile: LOAD DATA LOCAL INFILE)
+    load_mode = 'insert'
+    # エラー時の復旧方式(bisect: 二分割して不正行を切り分け / None: 1行ずつINSERT)
+    recovery = 'bisect'
+    # 不正行の隔離先(table: <テーブル名>__rejected / file: quarantine_file / None: 破棄)
+    quarantine_mode = 'table'
+    quarantine_file = 'rejected.jsonl'
+    # ストリーミング取得時の1回あたりの取得行数
+    fetch_size = 10000
+    # ストリーミング取得中の接続のnet_write_timeout(秒)。読み手が遅いとサーバーが既定の60秒で切断するため延ばす
+    net_write_timeout = 600
+    # コネクションプール設定(最大接続数・再接続までの秒数・取り出し時の生存確認)
+    pool_size = 5
+    pool_recycle = 3600
+    pool_ping = True
+    pool_timeout = 30
+    # 並列ロード(並列数・分割方法(hash / range)・分割に使うキー列)。接続はプールの空き接続数までしか使わない
+    parallel = 1
+    partition = 'hash'
+    partition_key = None
+
     def __init__(self, config=None, db_host='localhost'):
         self.connection = None
+        self.connection_pool = None
         self.engine = None
+        self.local_infile = None
         self.db_host = db_host
         self.db_port = None
         self.db_name = None
         self.db_user = None
         self.db_pass = None
+        # session()で固定した接続(スレッド毎)
+        self.pinned = threading.local()
         self.load_config(config)
 
     def load_config(self, config):
@@ -82,16 +489,105 @@ class MariaDB:
         self.db_user = config['user']
         self.db_pass = config['pass']
 
+    def set_load_config(self, config):
+        if not config:
+            return
+        self.batch_rows = int(config.get('batch_rows', self.batch_rows))
+        self.batch_bytes = int(config.get('batch_bytes', self.batch_bytes))
+        self.commit_batches = int(config.get('commit_batches', self.commit_batches))
+        self.load_mode = config.get('mode', self.load_mode)
+        self.recovery = config.get('recovery', self.recovery)
+        self.quarantine_mode = config.get('quarantine', self.quarantine_mode)
+        self.quarantine_file = config.get('quarantine_file', self.quarantine_file)
+        self.fetch_size = int(config.get('fetch_size', self.fetch_size))
+        self.net_write_timeout = int(config.get('net_write_timeout', self.net_write_timeout))
+        self.parallel = max(1, int(config.get('parallel', self.parallel)))
+        self.partition = config.get('partition', self.partition)
+        self.partition_key = config.get('partition_key', self.partition_key)
+
+    def set_pool_config(self, config):
+        if not config:
+            return
+        self.pool_size = int(config.get('size', self.pool_size))
+        self.pool_recycle = int(config.get('recycle', self.pool_recycle))
+        self.pool_ping = bool(config.get('ping', self.pool_ping))
+        self.pool_timeout = int(config.get('timeout', self.pool_timeout))
+
+    def get_connect_args(self):
+        import pymysql.cursors
+        return {
+            'host': self.db_host,
+            'port': self.db_port,
+            'user': self.db_user,
+            'password': self.db_pass,
+            'database': self.db_name,
+            'cursorclass': pymysql.cursors.DictCursor,
+            'local_infile': self.load_mode == 'infile',
+        }
+
+    def get_pool(self):
+        return get_pool(self.get_connect_args(), self.pool_size, self.pool_recycle, self.pool_ping, self.pool_timeout)
+
+    @contextmanager
+    def get_connection(self):
+        u"""
+        プールから接続を借り、ブロックを抜けたらROLLBACKしてから返却する
+        session()の中ではそのスレッドに固定した接続を返す
+        """
+        conn = getattr(self.pinned, 'conn', None)
+        if conn:
+            yield conn
+            return
+        pool = self.get_pool()
+        conn = pool.acquire()
+        try:
+            yield conn
+        finally:
+            pool.release(conn)
+
+    @contextmanager
+    def session(self, **variables):
+        u"""
+        1つの接続をこのスレッドに固定し、ブロック内のDB操作をセッション変数(unique_checksなど)を変更した同じ接続で行う
+        抜ける際にセッション変数を元に戻してプールへ返却する
+        """
+        if getattr(self.pinned, 'conn', None):
+            yield self.pinned.conn
+            return
+        with self.get_connection() as conn:
+            prev = {}
+            with conn.cursor() as cursor:
+                if variables:
+                    cursor.execute("SELECT " + ', '.join(["@@SESSION.{0} AS {0}".format(name) for name in variables]))
+                    prev = cursor.fetchone()
+                    cursor.execute("SET SESSION " + ', '.join(["{} = %s".format(name) for name in variables]), list(variables.values()))
+            self.pinned.conn = conn
+            self.pinned.variables = variables
+            try:
+                yield conn
+            finally:
+                self.pinned.conn = None
+                self.pinned.variables = None
+                if prev:
+                    with conn.cursor() as cursor:
+                        cursor.execute("SET SESSION " + ', '.join(["{} = %s".format(name) for name in prev]), list(prev.values()))
+
     def connect(self):
-        self.connection = pymysql.connect(
-            host=self.db_host,
-            port=self.db_port,
-            user=self.db_user,
-            password=self.db_pass,
-            database=self.db_name,
-            cursorclass=pymysql.cursors.DictCursor
-        )
-    
+        self.close()
+        self.connection_pool = self.get_pool()
+        self.connection = self.connection_pool.acquire()
+
+    def close(self):
+        if self.connection:
+            self.connection_pool.release(self.connection)
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
     def create_engine(self):
         url = 'mysql+pymysql://{}:{}@{}:{}/{}?charset=utf8'.format(
             self.db_user,
@@ -100,8 +596,9 @@ class MariaDB:
             self.db_port,
             self.db_name
         )
-        self.engine = sa.create_engine(url, echo=False)
+        self.engine = get_engine(url, self.pool_size, self.pool_recycle, self.pool_ping)
 
+    @metrics.timed('db.create_table')
     def create_table(self, table):
         res = None
         try:
@@ -115,76 +612,424 @@ class MariaDB:
             print('CREATE TABLE SQL: ' + sql)
         return res
 
+    def get_table_schema(self, table_name):
+        u"""
+        information_schemaから列(COLUMN_NAME・COLUMN_TYPE・IS_NULLABLE)のリストとインデックス(名前→列のリスト)を取得
+        """
+        with self.get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT COLUMN_NAME, COLUMN_TYPE, IS_NULLABLE FROM information_schema.COLUMNS"
+                " WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s ORDER BY ORDINAL_POSITION",
+                (self.db_name, table_name))
+            columns = cursor.fetchall()
+            cursor.execute(
+                "SELECT INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS"
+                " WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s ORDER BY INDEX_NAME, SEQ_IN_INDEX",
+                (self.db_name, table_name))
+            indexes = {}
+            for rec in cursor.fetchall():
+                indexes.setdefault(rec['INDEX_NAME'], []).append(rec['COLUMN_NAME'])
+        return columns, indexes
+
+    @metrics.timed('db.drop_indexes')
+    def drop_indexes(self, table):
+        u"""
+        tableのindexに指定したセカンダリインデックスのうち、既にあるものを1回のALTER TABLEで削除する(主キー・ユニークキーは残す)
+        """
+        columns, indexes = self.get_table_schema(table['name'])
+        sql = get_sql_for_drop_index(table['name'], [name for name in table.get('index') or [] if name in indexes])
+        if sql:
+            self.do_sql(sql)
+            print(sql)
+        return sql
+
+    @metrics.timed('db.migrate_table')
+    def migrate_table(self, table, with_index=True):
+        u"""
+        information_schemaの定義とtableを比較し、不足している列・インデックスの追加と型の変更を1回のALTER TABLEで反映する
+        ALGORITHM=INSTANT/INPLACEを優先し、サーバーが対応していない場合のみテーブル再構築を伴うALTERにする
+        """
+        import pymysql
+        columns, indexes = self.get_table_schema(table['name'])
+        if not columns:
+            return None
+        changes = get_schema_changes(table, columns, indexes, with_index)
+        if changes['extra_column']:
+            print('columns not in config({}): {}'.format(table['name'], ', '.join(changes['extra_column'])))
+        clauses = changes['add_column'] + changes['modify_column'] + changes['add_index']
+        if not clauses:
+            return None
+        for algorithm in get_algorithms(changes):
+            sql = get_sql_for_alter_table(table['name'], clauses, algorithm)
+            try:
+                with self.get_connection() as conn, conn.cursor() as cursor:
+                    cursor.execute(sql)
+                print(sql)
+                metrics.incr('schema_changes', len(clauses), algorithm=algorithm or 'DEFAULT')
+                return {'sql': sql, 'algorithm': algorithm, 'changes': changes}
+            except pymysql.err.MySQLError as e:
+                if algorithm is None or e.args[0] not in ALTER_ALGORITHM_ERRORS:
+                    raise
+                print('ALGORITHM={} is not supported: {}'.format(algorithm, e))
+
+    @metrics.timed('db.drop_table')
     def drop_table(self, table):
         drop_sql = "DROP TABLE IF EXISTS {}".format(table)
         self.do_sql(drop_sql)
         print(drop_sql)
 
+    # new_tableをtableに差し替える。旧テーブルはold_tableに退避する(1文で実行するためアトミック)
+    @metrics.timed('db.swap_table')
+    def swap_table(self, table, new_table, old_table):
+        sql = "RENAME TABLE {} TO {}, {} TO {}".format(
+            self.with_scheme(table), self.with_scheme(old_table),
+            self.with_scheme(new_table), self.with_scheme(table))
+        self.do_sql(sql)
+        print(sql)
+
+    @metrics.timed('db.truncate_table')
     def truncate_table(self, table_name: str):
         sql = "TRUNCATE TABLE " + self.with_scheme(table_name)
         self.do_sql(sql)
         print(sql)
 
+    @metrics.timed('db.fetch_one')
     def fetch_one(self, sql):
-        self.connect()
-        with self.connection.cursor() as cursor:
+        with self.get_connection() as conn, conn.cursor() as cursor:
             cursor.execute(sql)
             result = cursor.fetchone()
             return result
 
+    @metrics.timed('db.fetch_all')
     def fetch_all(self, sql):
-        self.connect()
-        with self.connection.cursor() as cursor:
+        with self.get_connection() as conn, conn.cursor() as cursor:
             cursor.execute(sql)
             result = cursor.fetchall()
             return result
     
+    @metrics.timed('db.fetch_all_df')
     def fetch_all_df(self, sql):
+        import pandas as pd
         self.create_engine()
         return pd.read_sql(sql, con=self.engine)
+
+    def iter_fetch(self, sql, fetch_size=None, as_dict=True, net_write_timeout=None):
+        u"""
+        サーバーサイドカーソル(SSDictCursor/SSCursor)でfetch_size件ずつ取得し、1行ずつ返す
+        読み終わるまで接続を占有するので、1行ごとの処理がnet_write_timeout秒を超えないようにする
+        """
+        import pymysql.cursors
+        fetch_size = fetch_size or self.fetch_size
+        net_write_timeout = int(net_write_timeout or self.net_write_timeout)
+        cursor_class = pymysql.cursors.SSDictCursor if as_dict else pymysql.cursors.SSCursor
+        with self.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SET SESSION net_write_timeout = {}".format(net_write_timeout))
+            cursor = conn.cursor(cursor_class)
+            completed = False
+            try:
+                cursor.execute(sql)
+                while True:
+                    rows = cursor.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    yield from rows
+                completed = True
+            finally:
+                if completed:
+                    cursor.close()
+                    # プールに戻す接続は既定値に戻しておく
+                    with conn.cursor() as cursor:
+                        cursor.execute("SET SESSION net_write_timeout = DEFAULT")
+                else:
+                    # 途中で打ち切った場合は残りを読み捨てず接続ごと破棄する
+                    conn.close()
+
+    def iter_fetch_df(self, sql, chunksize=None):
+        u"""
+        サーバーサイドカーソルでchunksize行ずつのDataFrameを返す
+        """
+        import pandas as pd
+        import sqlalchemy as sa
+        self.create_engine()
+        with self.engine.connect().execution_options(stream_results=True) as conn:
+            for df in pd.read_sql(sa.text(sql), con=conn, chunksize=chunksize or self.fetch_size):
+                yield df
     
+    @metrics.timed('db.do_sql')
     def do_sql(self, sql):
-        self.connect()
-        with self.connection.cursor() as cursor:
+        with self.get_connection() as conn, conn.cursor() as cursor:
             result = cursor.execute(sql)
             if result > 0:
-                self.connection.commit()
+                conn.commit()
         return result
 
+    @metrics.timed('db.insert')
     def insert(self, table, col_list, value):
-        self.connect()
-        with self.connection.cursor() as cursor:
+        with self.get_connection() as conn, conn.cursor() as cursor:
             placeholder_list = ["%s" for i in range(len(col_list))]
             sql = "INSERT INTO " + self.with_scheme(table) + " (" + ', '.join(col_list) + ") values (" + ', '.join(placeholder_list) + ")"
             result = cursor.execute(sql, value)
             if result > 0:
-                self.connection.commit()
+                conn.commit()
                 result = cursor.lastrowid
             return result
 
     def insert_many(self, table, col_list, value_list):
-        self.connect()
-        with self.connection.cursor() as cursor:
-            placeholder_list = ["%s" for i in range(len(col_list))]
-            sql = "INSERT INTO " + self.with_scheme(table) + " (" + ', '.join(col_list) + ") values (" + ', '.join(placeholder_list) + ")"
-            print(sql)
-            print(value_list)
-            result = cursor.executemany(sql, value_list)
-            if result > 0:
-                self.connection.commit()
-            return result
+        if self.is_parallel(value_list):
+            return check_parallel_result(table, self.parallel_insert(table, col_list, value_list))['rows']
+        result = self.bulk_insert(table, col_list, value_list)
+        return result['rows']
+
+    def iter_insert_batches(self, cursor, col_list, value_list):
+        u"""
+        行をエスケープ済みのVALUES句に変換し、行数・バイト数の上限ごとに(行, VALUES句, バイト数)で返す
+        """
+        placeholder = "(" + ', '.join(["%s" for i in range(len(col_list))]) + ")"
+        values = []
+        literals = []
+        size = 0
+        for value in value_list:
+            literal = cursor.mogrify(placeholder, value)
+            literal_size = len(literal.encode('utf-8')) + 1
+            if literals and (len(literals) >= self.batch_rows or size + literal_size > self.batch_bytes):
+                yield values, literals, size
+                values = []
+                literals = []
+                size = 0
+            values.append(value)
+            literals.append(literal)
+            size += literal_size
+        if literals:
+            yield values, literals, size
+
+    def get_sql_for_bulk_insert(self, table, col_list, literals, update_cols=None, strategy=None):
+        verb = {'ignore': "INSERT IGNORE INTO ", 'replace': "REPLACE INTO "}.get(strategy, "INSERT INTO ")
+        sql = verb + self.with_scheme(table) + " (" + ', '.join(col_list) + ") VALUES " + ','.join(literals)
+        # update_colsの指定があればキー重複時はUPDATEする(更新する列がなければ何もしないUPDATEにする)
+        if update_cols:
+            sql += " ON DUPLICATE KEY UPDATE " + ', '.join(["{0} = VALUES({0})".format(col) for col in update_cols])
+        elif strategy == 'update':
+            sql += " ON DUPLICATE KEY UPDATE {0} = {0}".format(col_list[0])
+        return sql
+
+    def execute_insert(self, cursor, table, col_list, literals, update_cols=None, strategy=None, changes=None):
+        affected = cursor.execute(self.get_sql_for_bulk_insert(table, col_list, literals, update_cols, strategy))
+        if strategy and changes is not None:
+            for name, count in count_changes(strategy, len(literals), affected, get_info(cursor)).items():
+                changes[name] += count
+
+    # 複数行INSERTによるバルクロード。commit_batches文ごとにCOMMITする
+    # strategyの指定(またはupdate_cols)があればキー重複時の扱いを変え、追加・更新・変更なしの件数も返す
+    @metrics.timed('db.bulk_insert')
+    def bulk_insert(self, table, col_list, value_list, update_cols=None, strategy=None):
+        start = time.perf_counter()
+        strategy = strategy or ('update' if update_cols else None)
+        changes = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        rows = 0
+        done = 0
+        batches = 0
+        size = 0
+        rejected = []
+        # 隔離した行(呼び出し元が不正行を除いて扱えるように返す)
+        rejected_rows = []
+        with self.get_connection() as conn, conn.cursor() as cursor:
+            try:
+                for values, literals, batch_size in self.iter_insert_batches(cursor, col_list, value_list):
+                    if self.recovery == 'bisect':
+                        rows += self.bisect_insert(cursor, table, col_list, values, literals, rejected, update_cols, strategy, changes)
+                    else:
+                        self.execute_insert(cursor, table, col_list, literals, update_cols, strategy, changes)
+                        rows += len(literals)
+                    done += len(literals)
+                    size += batch_size
+                    batches += 1
+                    if batches % self.commit_batches == 0:
+                        self.quarantine(cursor, table, rejected, rejected_rows)
+                        conn.commit()
+                self.quarantine(cursor, table, rejected, rejected_rows)
+            except Exception as e:
+                # 失敗した文より前の行は確定させ、処理済み件数を呼び出し元へ渡す
+                # 処理済みに含まれる切り分け済みの不正行は再実行されないため、ここで隔離する
+                self.quarantine(cursor, table, rejected, rejected_rows)
+                conn.commit()
+                raise BulkInsertError(done, e) from e
+            conn.commit()
+        sec = time.perf_counter() - start
+        result = {
+            'rows': rows,
+            'rejected': done - rows,
+            'rejected_rows': rejected_rows,
+            'batches': batches,
+            'sec': round(sec, 3),
+            'rows_per_sec': round(rows / sec, 1) if sec > 0 else 0.0,
+        }
+        metrics.incr('rows_loaded', rows)
+        metrics.incr('bytes_loaded', size)
+        metrics.incr('batches', batches)
+        metrics.incr('rejected_rows', done - rows)
+        msg = 'BULK INSERT {}: {rows} rows, {rejected} rejected, {batches} batches, {sec} sec, {rows_per_sec} rows/sec'.format(table, **result)
+        if strategy:
+            result.update(changes)
+            for name, count in changes.items():
+                metrics.incr('row_changes', count, change=name)
+            msg += ' ({}: {inserted} inserted, {updated} updated, {unchanged} unchanged)'.format(strategy, **changes)
+        print(msg)
+        return result
+
+    def bisect_insert(self, cursor, table, col_list, values, literals, rejected, update_cols=None, strategy=None, changes=None):
+        u"""
+        失敗したバッチを二分割しながら再実行し、不正な行だけをrejectedへ切り分ける
+        """
+        try:
+            self.execute_insert(cursor, table, col_list, literals, update_cols, strategy, changes)
+            return len(literals)
+        except get_recoverable_errors() as e:
+            if len(literals) == 1:
+                rejected.append((values[0], str(e)))
+                return 0
+        mid = len(literals) // 2
+        return (self.bisect_insert(cursor, table, col_list, values[:mid], literals[:mid], rejected, update_cols, strategy, changes)
+            + self.bisect_insert(cursor, table, col_list, values[mid:], literals[mid:], rejected, update_cols, strategy, changes))
+
+    def quarantine(self, cursor, table, rejected, quarantined=None):
+        u"""
+        不正な行をエラー内容と共に隔離テーブルまたはファイルへ書き出す。quarantinedの指定があれば隔離した行を追加する
+        """
+        if not rejected:
+            return
+        if quarantined is not None:
+            quarantined.extend([value for value, error in rejected])
+        now = dt.today().strftime("%Y-%m-%d %H:%M:%S")
+        if self.quarantine_mode == 'table':
+            quarantine_table = get_quarantine_table(table)
+            cursor.execute(get_sql_for_create_table(quarantine_table))
+            cursor.executemany(
+                "INSERT INTO " + self.with_scheme(quarantine_table['name']) + " (row_data, error, created) values (%s, %s, %s)",
+                [(json.dumps(value, ensure_ascii=False, default=str), error, now) for value, error in rejected]
+            )
+        elif self.quarantine_mode == 'file':
+            with open(self.quarantine_file, mode='a', encoding='utf-8') as f:
+                for value, error in rejected:
+                    f.write(json.dumps({'table': table, 'row': value, 'error': error, 'created': now}, ensure_ascii=False, default=str) + '\n')
+        print('quarantine {}: {} rows'.format(table, len(rejected)))
+        rejected.clear()
+
+    def get_parallel(self):
+        u"""
+        並列数。プールの空き接続数までに抑える(他のジョブ・スレッドが接続を使っていれば減らし、空きがなければ並列にしない)
+        ジョブ並列数×(parallel+1)がpool.sizeを超えると並列数が減るため、必要ならpool.sizeを増やす
+        """
+        if self.parallel <= 1:
+            return 1
+        return max(1, min(self.parallel, self.get_pool().available()))
+
+    def is_parallel(self, value_list):
+        # 1文に収まる件数なら分割しない
+        return self.get_parallel() > 1 and len(value_list) > self.batch_rows
+
+    @metrics.timed('db.parallel_insert')
+    def parallel_insert(self, table, col_list, value_list, key_cols=None, update_cols=None, strategy=None):
+        u"""
+        行をキー列のハッシュまたは範囲でparallel個に分け、パーティション毎にプールの別の接続で同時にbulk_insertする
+        キーが同じ行は同じ接続で入力順にロードされる。COMMITは接続毎にcommit_batches文ごとに行う
+        パーティションの失敗は送出せず、全パーティションの件数とエラーをまとめて返す
+        """
+        start = time.perf_counter()
+        key_cols = key_cols if key_cols is not None else (self.partition_key or [])
+        missing = [col for col in key_cols if col not in col_list]
+        if missing:
+            raise ValueError('partition key not in columns: ' + ', '.join(missing))
+        key_idx = [col_list.index(col) for col in key_cols]
+        if not hasattr(value_list, '__getitem__'):
+            value_list = list(value_list)
+        partitions = get_partitions(value_list, key_idx, self.get_parallel(), self.partition)
+        # session()の変数(unique_checksなど)は各接続にも設定する
+        variables = getattr(self.pinned, 'variables', None) or {}
+        with ThreadPoolExecutor(max_workers=max(1, len(partitions))) as executor:
+            futures = [executor.submit(self.insert_partition, table, col_list, take_rows(value_list, indexes), update_cols, variables, strategy) for indexes in partitions]
+            results = [future.result() for future in futures]
+        sec = time.perf_counter() - start
+        rows = sum([res['rows'] for res in results])
+        errors = [{'partition': i, 'rows': res['total'], 'loaded': res['rows'], 'error': res['error']} for i, res in enumerate(results) if res['error']]
+        result = {
+            'rows': rows,
+            'rejected': sum([res['rejected'] for res in results]),
+            'batches': sum([res['batches'] for res in results]),
+            'partitions': len(partitions),
+            'sec': round(sec, 3),
+            'rows_per_sec': round(rows / sec, 1) if sec > 0 else 0.0,
+            'results': results,
+            'errors': errors,
+        }
+        for name in ('inserted', 'updated', 'unchanged'):
+            if any([name in res for res in results]):
+                result[name] = sum([res.get(name, 0) for res in results])
+        metrics.incr('partitions', len(partitions))
+        metrics.incr('partition_errors', len(errors))
+        print('PARALLEL INSERT {}: {rows} rows, {rejected} rejected, {partitions} partitions, {sec} sec, {rows_per_sec} rows/sec'.format(table, **result))
+        for error in errors:
+            print('partition {partition}: {loaded}/{rows} rows, ERROR: {error}'.format(**error))
+        return result
+
+    def insert_partition(self, table, col_list, value_list, update_cols=None, variables=None, strategy=None):
+        u"""
+        parallel_insertの1パーティションを1つの接続でロードする
+        バルクロードに失敗したら残りを1行ずつINSERTし(UPSERT時は行わない)、最初のエラーを結果に入れて返す
+        """
+        result = {'rows': 0, 'rejected': 0, 'batches': 0, 'sec': 0.0, 'total': len(value_list), 'error': None}
+        start = time.perf_counter()
+        try:
+            # 接続を借りられない場合(PoolTimeoutなど)もこのパーティションのエラーとして返す
+            with self.session(**(variables or {})):
+                try:
+                    result.update(self.bulk_insert(table, col_list, value_list, update_cols, strategy))
+                except Exception as e:
+                    done = getattr(e, 'rows', 0)
+                    result['rows'] = done
+                    result['error'] = repr(e)
+                    if not update_cols and not strategy:
+                        metrics.incr('fallbacks', kind='single_insert')
+                        try:
+                            for insert_row in value_list[done:]:
+                                self.insert(table, col_list, insert_row)
+                                result['rows'] += 1
+                        except Exception as e:
+                            result['error'] += ' / single insert: ' + repr(e)
+                        metrics.incr('rows_loaded', result['rows'] - done)
+        except Exception as e:
+            result['error'] = repr(e)
+        result['sec'] = round(time.perf_counter() - start, 3)
+        return result
+
+    # キー列の値が一致する行をbatch_rows件ずつまとめて削除する
+    @metrics.timed('db.delete_by_keys')
+    def delete_by_keys(self, table, key_cols, key_list):
+        result = 0
+        placeholder = "(" + ', '.join(["%s" for i in range(len(key_cols))]) + ")"
+        with self.get_connection() as conn, conn.cursor() as cursor:
+            for keys in slice_list(list(key_list), self.batch_rows):
+                sql = "DELETE FROM " + self.with_scheme(table) + " WHERE (" + ', '.join(key_cols) + ") IN (" + ','.join([cursor.mogrify(placeholder, key) for key in keys]) + ")"
+                result += cursor.execute(sql)
+            conn.commit()
+        return result
 
     # バルクインサート。もしエラーになればインサート処理に切り替える
+    # 1行ずつのINSERTも失敗した場合はLoadErrorを送出する(呼び出し元で部分的なロードを確定させないため)
     def insert_many_iferr_switch_insert(self, table, col_list, value_list):
         msg = ''
         try:
-            result = self.insert_many(table, col_list, value_list)
-            msg = 'BULK INSERT Results:{}'.format(str(result))
+            result = self.bulk_insert(table, col_list, value_list)
+            msg = 'BULK INSERT Results:{} Rejected:{}'.format(str(result['rows']), str(result['rejected']))
         except Exception as e:
             print('switch insert one mode')
+            metrics.incr('fallbacks', kind='single_insert')
+            print(e)
             result_list = []
+            done = getattr(e, 'rows', 0)
             try:
-                for insert_row in value_list:
+                # ロード済みの行は飛ばして残りを1行ずつINSERTする
+                for insert_row in value_list[done:]:
                     result_list.append(self.insert(table, col_list, insert_row))
             except Exception as e:
                 t, v, tb = sys.exc_info()
@@ -192,9 +1037,105 @@ class MariaDB:
                 pprint(traceback.format_tb(e.__traceback__))
                 print(col_list)
                 print(insert_row)
+                metrics.incr('rows_loaded', len(result_list))
+                raise LoadError(table, done + len(result_list), len(value_list), e) from e
+            metrics.incr('rows_loaded', len(result_list))
             msg = "INSERT(school): {}".format(str(len(result_list)))
         return msg
 
+    # ロード方式に応じてロードする。LOAD DATAが使えない場合はINSERTに切り替える
+    @metrics.timed('db.load')
+    def load(self, table, col_list, value_list):
+        import pymysql
+        if self.load_mode == 'infile':
+            if self.is_local_infile_enabled():
+                try:
+                    result = self.load_data_infile(table, col_list, value_list)
+                    return 'LOAD DATA Results:{}'.format(str(result['rows']))
+                except LoadError as e:
+                    # 読み飛ばされた行があればロールバック済みなので、このバッチはINSERTで入れ直してエラーを拾う
+                    print('LOAD DATA skipped rows. switch insert mode: {}'.format(e))
+                    metrics.incr('fallbacks', kind='infile_skipped')
+                except pymysql.err.MySQLError as e:
+                    if e.args[0] not in LOCAL_INFILE_ERRORS:
+                        raise
+                    self.local_infile = False
+            if not self.local_infile:
+                print('local_infile is disabled. switch insert mode')
+                metrics.incr('fallbacks', kind='infile')
+        if self.is_parallel(value_list):
+            result = check_parallel_result(table, self.parallel_insert(table, col_list, value_list))
+            return 'PARALLEL INSERT Results:{} Rejected:{} Errors:{}'.format(str(result['rows']), str(result['rejected']), str(len(result['errors'])))
+        return self.insert_many_iferr_switch_insert(table, col_list, value_list)
+
+    @metrics.timed('db.merge')
+    def merge(self, table, col_list, value_list, strategy='update', key_cols=None, update_cols=None):
+        u"""
+        キーが重複する行をstrategy(update / ignore / replace)に従って扱いながら複数行INSERTでロードし、
+        追加・更新・変更なしの件数を含む結果を返す。updateでupdate_colsがNoneならkey_colsとcreated以外の全列を更新する
+        """
+        if strategy not in MERGE_STRATEGIES:
+            raise ValueError('unknown merge strategy: ' + str(strategy))
+        key_cols = key_cols or []
+        if strategy == 'update' and update_cols is None:
+            update_cols = [col for col in col_list if col not in key_cols and col != 'created']
+        if strategy != 'update':
+            update_cols = None
+        if self.is_parallel(value_list):
+            # 同じキーの行の順序を保つため、キー列で分割する
+            partition_key = key_cols if key_cols and all([col in col_list for col in key_cols]) else None
+            return self.parallel_insert(table, col_list, value_list, partition_key, update_cols, strategy)
+        return self.bulk_insert(table, col_list, value_list, update_cols, strategy)
+
+    def is_local_infile_enabled(self):
+        if self.local_infile is None:
+            res = self.fetch_one("SHOW GLOBAL VARIABLES LIKE 'local_infile'")
+            self.local_infile = bool(res) and res['Value'].upper() in ('ON', '1')
+        return self.local_infile
+
+    @metrics.timed('db.load_data_infile')
+    def load_data_infile(self, table, col_list, value_list):
+        u"""
+        行をTSVの一時ファイルに書き出し、LOAD DATA LOCAL INFILEでロードする
+        """
+        start = time.perf_counter()
+        rows = 0
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='', suffix='.tsv', delete=False) as f:
+            tsv_file = f.name
+            for value in value_list:
+                f.write('\t'.join([escape_tsv(v) for v in value]) + '\n')
+                rows += 1
+        size = os.path.getsize(tsv_file)
+        try:
+            sql = (
+                "LOAD DATA LOCAL INFILE %s INTO TABLE " + self.with_scheme(table) +
+                " CHARACTER SET utf8mb4 FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\'" +
+                " LINES TERMINATED BY '\\n' (" + ', '.join(col_list) + ")"
+            )
+            with self.get_connection() as conn, conn.cursor() as cursor:
+                # LOCALはIGNORE扱いで、重複・変換できない行は警告だけで読み飛ばされるため件数を確かめる
+                loaded = cursor.execute(sql, (tsv_file,))
+                if loaded < rows:
+                    cursor.execute("SHOW WARNINGS LIMIT 5")
+                    warnings = cursor.fetchall()
+                    conn.rollback()
+                    raise LoadError(table, loaded, rows, '; '.join([w['Message'] for w in warnings]) or 'rows skipped')
+                conn.commit()
+        finally:
+            os.remove(tsv_file)
+        sec = time.perf_counter() - start
+        result = {
+            'rows': loaded,
+            'batches': 1,
+            'sec': round(sec, 3),
+            'rows_per_sec': round(rows / sec, 1) if sec > 0 else 0.0,
+        }
+        metrics.incr('rows_loaded', loaded)
+        metrics.incr('bytes_loaded', size)
+        metrics.incr('batches', 1)
+        print('LOAD DATA {}: {rows} rows, {sec} sec, {rows_per_sec} rows/sec'.format(table, **result))
+        return result
+
     def with_scheme(self, table):
         return self.db_name + "." + table
 
@@ -239,25 +1180,71 @@ class AnalyticsDB(CoreDB):
 SQLite操作用クラス
 """
 class SQLite():
+
+    # バルクロード設定(1トランザクションあたりの行数・ロード中のPRAGMA)
+    batch_rows = 10000
+    journal_mode = 'WAL'
+    synchronous = 'OFF'
+
     def __init__(self, table_struct, exec_dir=None):
         self.db_file = table_struct['db_file']
         self.table = table_struct['name']
         self.exec_dir = exec_dir
         self.connection = None
 
-    def create_table(self, table_struct=None, is_recreate=False):
+    def set_load_config(self, config):
+        if not config:
+            return
+        self.batch_rows = int(config.get('batch_rows', self.batch_rows))
+        self.journal_mode = config.get('journal_mode', self.journal_mode)
+        self.synchronous = config.get('synchronous', self.synchronous)
+
+    def create_table(self, table_struct=None, is_recreate=False, with_index=True):
         if is_recreate:
             print('Recreate Table.')
             self.drop_table(table_struct['name'])
         self.do_sql(self.get_sql_for_create_table(table_struct))
+        if with_index:
+            self.migrate_table(table_struct)
+
+    def get_index_name(self, table, index_col):
+        # SQLiteのインデックス名はDB内で一意にする必要がある
+        return '{}__{}'.format(table['name'], index_col)
+
+    def migrate_table(self, table, with_index=True):
+        u"""
+        indexに指定したインデックスのうち無いものを作成する(列の追加・変更は行わない)
+        """
+        if not with_index:
+            return None
+        for index_col in table.get('index') or []:
+            self.do_sql('CREATE INDEX IF NOT EXISTS `{}` ON `{}` (`{}`)'.format(self.get_index_name(table, index_col), table['name'], index_col))
+        return None
+
+    def drop_indexes(self, table):
+        for index_col in table.get('index') or []:
+            self.do_sql('DROP INDEX IF EXISTS `{}`'.format(self.get_index_name(table, index_col)))
+
+    @contextmanager
+    def session(self, **variables):
+        # SQLiteは接続が1つのため何もしない(MariaDB.sessionと同じ呼び出し方にする)
+        yield self.get_conn()
 
     def get_abs_path(self, file_path):
         if self.exec_dir:
             return self.exec_dir + '/' + file_path
         return file_path
 
+    # 接続は1本を使い回す
     def get_conn(self):
-        return sqlite3.connect(self.get_abs_path(self.db_file))
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.get_abs_path(self.db_file), check_same_thread=False)
+        return self.connection
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
 
     def fetch_one(self, sql):
         res = None
@@ -323,30 +1310,64 @@ class SQLite():
         return res
 
     def insert_many(self, table, col_list, value_list):
-        res = None
+        result = self.bulk_insert(table, col_list, value_list)
+        return 'InsertResults: {}'.format(str(result['rows']))
+
+    def bulk_insert(self, table, col_list, value_list):
+        u"""
+        batch_rows行ずつexecutemanyし、バッチ毎にCOMMITする。失敗したバッチはROLLBACKしてerrorsに記録する
+        """
+        start = time.perf_counter()
+        rows = 0
+        batches = 0
+        errors = []
+        self.conn = self.get_conn()
+        placeholder = ','.join(['?' for col in col_list])
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(table, ','.join(col_list), placeholder)
+        # ロード中のみ同期書き込みを緩める(journal_modeはDBファイルに保持される)
+        prev_synchronous = self.conn.execute('PRAGMA synchronous').fetchone()[0]
+        if self.journal_mode:
+            self.conn.execute('PRAGMA journal_mode={}'.format(self.journal_mode))
+        if self.synchronous:
+            self.conn.execute('PRAGMA synchronous={}'.format(self.synchronous))
         try:
-            self.conn = self.get_conn()
-            cursor = self.conn.cursor()
-            placeholder = ','.join(['?' for col in col_list])
-            sql = 'INSERT INTO {} ({}) VALUES ({})'.format(table, ','.join(col_list), placeholder)
-            for value in value_list:
-                cursor.execute(sql, value)
-            self.conn.commit()
-            res = 'InsertResults: {}'.format(str(len(value_list)))
-        except Exception as e:
-            t, v, tb = sys.exc_info()
-            pprint(traceback.format_exception(t,v,tb))
-            pprint(traceback.format_tb(e.__traceback__))
-            cursor.close()
-            sys.exit()
-        cursor.close()
-        return res
+            for values in iter_chunks(value_list, self.batch_rows):
+                batches += 1
+                try:
+                    with self.conn:
+                        self.conn.executemany(sql, values)
+                    rows += len(values)
+                except sqlite3.Error as e:
+                    errors.append({'batch': batches, 'rows': len(values), 'error': str(e)})
+                    print('SQLite bulk insert error(batch {}): {}'.format(batches, e))
+        finally:
+            self.conn.execute('PRAGMA synchronous={}'.format(prev_synchronous))
+        sec = time.perf_counter() - start
+        metrics.incr('rows_loaded', rows)
+        metrics.incr('batches', batches)
+        return {
+            'rows': rows,
+            'batches': batches,
+            'errors': errors,
+            'sec': round(sec, 3),
+            'rows_per_sec': round(rows / sec, 1) if sec > 0 else 0.0,
+        }
 
+    # SQLiteにはTRUNCATEがないためDELETEで全件削除する
     def truncate_table(self, table):
-        sql = "TRUNCATE TABLE " + table
+        sql = "DELETE FROM " + table
         self.do_sql(sql)
         print(sql)
 
+    def with_scheme(self, table):
+        return table
+
+    def load(self, table, col_list, value_list):
+        result = self.bulk_insert(table, col_list, value_list)
+        if result['errors']:
+            raise LoadError(table, result['rows'], len(value_list), '; '.join([error['error'] for error in result['errors']]))
+        return 'BULK INSERT Results:{} Errors:{}'.format(str(result['rows']), str(len(result['errors'])))
+
     def get_sql_for_create_table(self, table):
         # SQLiteとMariaDBの型変換表
         cnv_list = {
@@ -364,11 +1385,15 @@ class SQLite():
                 if cnv in col['type']:
                     type = change_type
                     break
+            option = col['option'] if 'option' in col.keys() else ''
+            # MariaDBのAUTO_INCREMENTは主キーのAUTOINCREMENTに置き換える
+            if option == 'AUTO_INCREMENT':
+                option = 'PRIMARY KEY AUTOINCREMENT' if col['name'] == table.get('primary_key') else ''
             col_list.append(
                 "`{}` {} {}".format(
                     col['name'],
                     type,
-                    col['option'] if 'option' in col.keys() else ''
+                    option
                 )
             )
         sql_part_col = ",\n".join(col_list)
@@ -0,0 +1,91 @@
+"""
+===============================================================================>
+
+DB→スプレッドシート書き出し
+
+===============================================================================>
+"""
+import time
+import myutil
+
+# 1リクエスト(values:batchUpdate)あたりのセル数の上限
+MAX_CELLS_PER_REQUEST = 50000
+
+
+def to_cell(value):
+    if value is None:
+        return ''
+    return str(value)
+
+def get_changed_ranges(existing, values, start_row, width):
+    u"""
+    既存の値と比較し、変わった行を連続する範囲ごとにまとめて [{'range': 'A2:D5', 'values': [...]}] で返す
+    """
+    last_col = myutil.col_to_a1(width)
+    ranges = []
+    block = []
+    block_start = None
+    for offset, row in enumerate(values):
+        current = existing[offset] if offset < len(existing) else []
+        current = current[:width] + [''] * (width - len(current))
+        if row == current:
+            if block:
+                ranges.append({'range': 'A{}:{}{}'.format(block_start, last_col, block_start + len(block) - 1), 'values': block})
+                block = []
+            continue
+        if not block:
+            block_start = start_row + offset
+        block.append(row)
+    if block:
+        ranges.append({'range': 'A{}:{}{}'.format(block_start, last_col, block_start + len(block) - 1), 'values': block})
+    return ranges
+
+def export_query(maria_db, sql, worksheet, batch_rows=1000, fetch_size=None, max_cells=MAX_CELLS_PER_REQUEST, net_write_timeout=None):
+    u"""
+    クエリ結果をサーバーサイドカーソルで読みながらワークシートへ書き出す
+    batch_rows行ずつ既存の値と比較し、変わった範囲だけをmax_cells単位のbatch_updateでまとめて書き込む
+    シートAPIの呼び出し中もカーソルを開いたままなので、net_write_timeout秒以内に次を読めるようにしておく
+    """
+    start = time.perf_counter()
+    rows = 0
+    requests = 0
+    written = 0
+    width = 0
+    next_row = 1
+    pending = []
+    pending_cells = 0
+    for chunk in myutil.iter_chunks(maria_db.iter_fetch(sql, fetch_size, net_write_timeout=net_write_timeout), batch_rows):
+        values = [[to_cell(v) for v in row.values()] for row in chunk]
+        # 1行目はヘッダー行
+        if next_row == 1:
+            width = len(chunk[0])
+            values.insert(0, list(chunk[0].keys()))
+            if worksheet.col_count < width:
+                worksheet.add_cols(width - worksheet.col_count)
+        end_row = next_row + len(values) - 1
+        if worksheet.row_count < end_row:
+            worksheet.add_rows(end_row - worksheet.row_count)
+        existing = worksheet.get_values('A{}:{}{}'.format(next_row, myutil.col_to_a1(width), end_row))
+        for changed in get_changed_ranges(existing, values, next_row, width):
+            cells = len(changed['values']) * width
+            if pending and pending_cells + cells > max_cells:
+                worksheet.batch_update(pending, value_input_option='RAW')
+                requests += 1
+                pending = []
+                pending_cells = 0
+            pending.append(changed)
+            pending_cells += cells
+            written += len(changed['values'])
+        rows += len(chunk)
+        next_row = end_row + 1
+    if pending:
+        worksheet.batch_update(pending, value_input_option='RAW')
+        requests += 1
+    # 前回の書き出しより行が減った場合は残りを消す
+    if width and worksheet.row_count >= next_row:
+        worksheet.batch_clear(['A{}:{}'.format(next_row, myutil.col_to_a1(max(width, worksheet.col_count)))])
+        requests += 1
+    sec = time.perf_counter() - start
+    result = {'rows': rows, 'written_rows': written, 'requests': requests, 'sec': round(sec, 3)}
+    print('EXPORT: {rows} rows, {written_rows} rows written, {requests} requests, {sec} sec'.format(**result))
+    return result
@@ -0,0 +1,140 @@
+"""
+===============================================================================>
+
+gspreadのローカル代替(テスト・ベンチマーク用)
+
+===============================================================================>
+"""
+import re
+import myutil
+
+A1_RANGE = re.compile(r'^([A-Z]+)(\d+)(?::([A-Z]+)(\d+)?)?$')
+
+
+def parse_a1_range(a1_range):
+    u"""
+    'A2:C10' 形式の範囲を(開始行, 開始列, 終了行, 終了列)に変換(いずれも1始まり)
+    """
+    m = A1_RANGE.match(a1_range.split('!')[-1].upper())
+    if not m:
+        raise ValueError('invalid range: ' + a1_range)
+    start_col = myutil.a1_to_col(m.group(1))
+    start_row = int(m.group(2))
+    end_col = myutil.a1_to_col(m.group(3)) if m.group(3) else start_col
+    end_row = int(m.group(4)) if m.group(4) else (start_row if not m.group(3) else None)
+    return start_row, start_col, end_row, end_col
+
+"""
+ワークシート
+"""
+class FakeWorksheet:
+
+    def __init__(self, title, values=None):
+        self.title = title
+        self.values = [list(row) for row in values or []]
+        self.calls = []
+        # グリッドのサイズ(値のある範囲より大きくできる)
+        self.rows = max(len(self.values), 1)
+        self.cols = max([len(row) for row in self.values] + [1])
+
+    @property
+    def row_count(self):
+        return self.rows
+
+    @property
+    def col_count(self):
+        return self.cols
+
+    def batch_get(self, ranges):
+        self.calls.append(('batch_get', list(ranges)))
+        return [self.get_values(range_name) for range_name in ranges]
+
+    def add_rows(self, rows):
+        self.calls.append(('add_rows', rows))
+        self.rows += rows
+
+    def add_cols(self, cols):
+        self.calls.append(('add_cols', cols))
+        self.cols += cols
+
+    def set_cell(self, row, col, value):
+        while len(self.values) < row:
+            self.values.append([])
+        cells = self.values[row - 1]
+        while len(cells) < col:
+            cells.append('')
+        cells[col - 1] = value
+
+    def batch_update(self, data, value_input_option=None):
+        self.calls.append(('batch_update', [d['range'] for d in data]))
+        for d in data:
+            start_row, start_col, end_row, end_col = parse_a1_range(d['range'])
+            if start_row + len(d['values']) - 1 > self.rows:
+                raise ValueError('range exceeds grid limits: ' + d['range'])
+            for r, row in enumerate(d['values']):
+                for c, value in enumerate(row):
+                    self.set_cell(start_row + r, start_col + c, value)
+
+    def batch_clear(self, ranges):
+        self.calls.append(('batch_clear', ranges))
+        for range_name in ranges:
+            start_row, start_col, end_row, end_col = parse_a1_range(range_name)
+            for cells in self.values[start_row - 1:end_row]:
+                for c in range(start_col - 1, min(end_col, len(cells))):
+                    cells[c] = ''
+
+    def get_all_values(self):
+        self.calls.append(('get_all_values',))
+        return [list(row) for row in self.values]
+
+    def get_values(self, range_name=None):
+        u"""
+        APIと同じく末尾の空行・空セルを除いて返す
+        """
+        self.calls.append(('get_values', range_name))
+        if range_name is None:
+            return self.get_all_values()
+        start_row, start_col, end_row, end_col = parse_a1_range(range_name)
+        end_row = end_row or len(self.values)
+        res = []
+        for row in self.values[start_row - 1:end_row]:
+            cells = [str(v) for v in row[start_col - 1:end_col]]
+            while cells and cells[-1] == '':
+                cells.pop()
+            res.append(cells)
+        while res and not res[-1]:
+            res.pop()
+        return res
+
+"""
+スプレッドシート
+"""
+class FakeSpreadsheet:
+
+    def __init__(self, key, worksheets=None):
+        self.id = key
+        # Drive APIのmodifiedTime相当。シートの更新を再現する場合は書き換える
+        self.lastUpdateTime = '2024-01-01T00:00:00.000Z'
+        self.worksheets = {}
+        for title, values in (worksheets or {}).items():
+            self.add_worksheet(title, values)
+
+    def add_worksheet(self, title, values=None):
+        self.worksheets[title] = FakeWorksheet(title, values)
+        return self.worksheets[title]
+
+    def worksheet(self, title):
+        return self.worksheets[title]
+
+"""
+gspread.Client の代替
+"""
+class FakeClient:
+
+    def __init__(self, spreadsheets=None):
+        self.spreadsheets = {}
+        for key, worksheets in (spreadsheets or {}).items():
+            self.spreadsheets[key] = FakeSpreadsheet(key, worksheets)
+
+    def open_by_key(self, key):
+        return self.spreadsheets[key]
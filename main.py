@@ -1,66 +1,122 @@
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 from datetime import datetime as dt
-import pandas as pd
-from pprint import pprint
 import sys
 import os
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 import db
 import myutil
+import sheetcache
+import export
+import rowstore
+import sheetclient
+import metrics
 
-# コンフィグ設定
-CONFIG = {}
-with open(os.path.dirname(__file__) + '/config.json', encoding="utf-8") as f:
-    CONFIG = json.load(f)
+# コンフィグ設定(初回のget_configで読み込む)
+CONFIG = None
+
+def get_config():
+    global CONFIG
+    if CONFIG is None:
+        with open(os.path.dirname(__file__) + '/config.json', encoding="utf-8") as f:
+            CONFIG = json.load(f)
+    return CONFIG
+
+# 認証済みgspreadクライアント(レート制限・リトライ付き。ジョブ間で共有)
+def get_client():
+    return sheetclient.get_client(os.path.dirname(__file__)+'/auth_key_knishi.json', get_config().get('sheets_api'))
+
+def get_db(db_name, load_config=None):
+    db_config={}
+    db_config['host'] = 'localhost'
+    db_config['port'] = 3366
+    db_config['db'] = db_name
+    db_config['user'] = 'root'
+    db_config['pass'] = 'root'
+    analytics_db = db.AnalyticsDB(config=db_config)
+    analytics_db.set_load_config(load_config)
+    analytics_db.set_pool_config(get_config().get('pool'))
+    #analytics_db.db_host = self.db_host
+    return analytics_db
+
+def is_frame(data):
+    # pandasを読み込んでいなければDataFrameではない
+    pd = sys.modules.get('pandas')
+    return pd is not None and isinstance(data, pd.DataFrame)
 
 class SpreadSheet():
 
-    def __init__(self, db_host=CONFIG['DB_HOST'], debug_mode=CONFIG['DEBUG_MODE'], insert_mode=CONFIG['INSERT_MODE']):
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        creds = ServiceAccountCredentials.from_json_keyfile_name(os.path.dirname(__file__)+'/auth_key_knishi.json', scope)
-        gs = gspread.authorize(creds)
+    def __init__(self, db_host=None, debug_mode=None, insert_mode=None, client=None, job=None, db_obj=None):
+        config = get_config()
+        # jobの指定があればspreadsheet・table・loadを上書き(未指定の項目はconfig.jsonの値)
+        job = job or {}
+        self.job_name = job.get('name', 'main')
         self.debug_mode = False
-        self.sheet_key = CONFIG['spreadsheet']['id']
-        self.workbook = gs.open_by_key(self.sheet_key)
-        self.db_host = db_host
-        self.insert_mode = insert_mode
-        self.debug_mode = debug_mode
-        self.table = CONFIG['table']
-        self.log_sign = '[MAIN]'
-        self.log_file = CONFIG['LOG_FILE']
-
-    def create_table(self, db_name):
-        sql_base = "CREATE TABLE IF NOT EXISTS `{}` ({}) ENGINE={};"
-        col_list = []
-        for col in self.table['columns']:
-            col_list.append(
-                "`{}` {} {} {}{}".format(
-                    col['name'],
-                    col['type'],
-                    'NULL' if col['null'] else 'NOT NULL',
-                    'DEFAULT ' + col['default'] if col['default'] else '',
-                    col['option'] if 'option' in col.keys() else ''
-                )
-            )
-        sql_part_col = ",\n".join(col_list)
-        if self.table['primary_key']:
-            sql_part_col = sql_part_col + ", PRIMARY KEY (`{}`)".format(self.table['primary_key'])
-        sql = sql_base.format(
-            self.table['name'],
-            sql_part_col,
-            self.table['engine'])
+        self.spreadsheet = job.get('spreadsheet', config['spreadsheet'])
+        self.sheet_key = self.spreadsheet['id']
+        with metrics.span('auth', job=self.job_name):
+            # clientの指定がなければ認証済みクライアントを共有(テスト時はfakesheet.FakeClientを渡す)
+            gs = client or get_client()
+            self.workbook = gs.open_by_key(self.sheet_key)
+        self.db_host = db_host if db_host is not None else config['DB_HOST']
+        self.insert_mode = insert_mode if insert_mode is not None else config['INSERT_MODE']
+        self.debug_mode = debug_mode if debug_mode is not None else config['DEBUG_MODE']
+        self.table = job.get('table', config['table'])
+        self.log_sign = '[{}]'.format(job['name']) if 'name' in job else '[MAIN]'
+        self.log_file = config['LOG_FILE']
+        self.load_config = dict(config.get('load', {}), **job.get('load', {}))
+        # 並列ロードではシートのキー列で行を分割する(同じキーの行は同じ接続へ入る)
+        self.load_config.setdefault('partition_key', self.spreadsheet.get('key'))
+        # db_objの指定があればDB名によらずそのDBへロードする(db.SQLiteも可)
+        self.db_obj = db_obj
+        self.db_objs = {}
+        # 取得した行を書き込むキャッシュのスナップショット(sheetcache.Snapshot)
+        self.snapshot = None
+
+    def create_table(self, db_name, table_name=None, with_index=True, migrate=True):
+        # SQLiteへのロード時はSQLiteの型で作成
+        if isinstance(self.get_db(db_name), db.SQLite):
+            self.get_db(db_name).create_table(self.get_table_struct(table_name), with_index=with_index and migrate)
+            return
+        table = self.get_table_struct(table_name)
+        sql = db.get_sql_for_create_table(table, with_index)
         self.output_log('SQL: ' + sql)
-        db_config={}
-        db_config['host'] = 'localhost'
-        db_config['port'] = 3366
-        db_config['db'] = db_name
-        db_config['user'] = 'root'
-        db_config['pass'] = 'root'
-        analytics_db = db.AnalyticsDB(config=db_config)
-        #analytics_db.db_host = self.db_host
-        res = analytics_db.do_sql(sql)
+        res = self.get_db(db_name).do_sql(sql)
         self.output_log("Result(create table): " + str(res))
+        # 既存テーブルはconfig.jsonの定義との差分をALTER TABLEで反映
+        if not migrate:
+            return
+        migration = self.get_db(db_name).migrate_table(table, with_index)
+        if migration:
+            self.output_log('SQL: ' + migration['sql'])
+
+    def get_table_struct(self, table_name=None):
+        table = dict(self.table)
+        if table_name:
+            table['name'] = table_name
+        # マージではキー重複を判定するユニークキーを設定
+        merge = self.get_merge()
+        if merge:
+            table['unique'] = merge['key']
+        # 差分同期ではキー列でUPSERTするためユニークキーを設定
+        if self.load_config.get('sync') == 'delta':
+            table['unique'] = self.spreadsheet['key']
+        return table
+
+    # create_table・insert_dataで共有するDBオブジェクト(接続はプールから借りる)
+    def get_db(self, db_name):
+        if self.db_obj:
+            return self.db_obj
+        if db_name not in self.db_objs:
+            self.db_objs[db_name] = get_db(db_name, self.load_config)
+        return self.db_objs[db_name]
+
+    def get_cache_target(self, db_name=None):
+        u"""
+        シートキャッシュのロード先。DB名・テーブル名と、列の対応・テーブル定義のハッシュ(設定を変えたら再取得する)
+        """
+        config_hash = myutil.row_hash({'pair': self.spreadsheet['pair'], 'table': self.table})
+        return '{}.{}#{}'.format(db_name or '', self.table['name'], config_hash)
 
     def output_log(self, msg):
         log_msg = self.log_sign + ' ' + msg
@@ -68,64 +124,447 @@ class SpreadSheet():
             print(log_msg)
         myutil.output_log(self.log_file, log_msg)
 
+    def get_revision(self):
+        u"""
+        シートの更新日時(Drive APIのmodifiedTime)。取得できない場合はNone
+        """
+        if hasattr(self.workbook, 'get_lastUpdateTime'):
+            return self.workbook.get_lastUpdateTime()
+        return getattr(self.workbook, 'lastUpdateTime', None)
+
     def get_data(self):
-        worksheet = self.workbook.worksheet(CONFIG['spreadsheet']['name'])
-        all_rec = worksheet.get_all_values()
         rec_list = []
-        for row_idx,row in enumerate(all_rec):
-            # ヘッダー行はスキップ
-            if row_idx == 0:
-                continue
-            dict = {}
-            for info in CONFIG['spreadsheet']['pair']:
-                #print(info)
-                #print(row)
-                dict[info['col']] = row[int(info['idx'])]
-            rec_list.append(dict)
-        pprint(rec_list)
+        with metrics.span('get_data', job=self.job_name):
+            for batch in self.iter_data():
+                rec_list.extend(batch)
+        return rec_list
+
+    def iter_rows(self, batch_rows=None):
+        u"""
+        シートをbatch_rows行ずつA1範囲で取得し、ヘッダー行を除いた行のリストを順に返す
+        """
+        batch_rows = batch_rows or int(self.spreadsheet.get('batch_rows', 5000))
+        worksheet = self.workbook.worksheet(self.spreadsheet['name'])
+        width = max([int(info['idx']) for info in self.spreadsheet['pair']]) + 1
+        last_col = myutil.col_to_a1(width)
+        # 1行目はヘッダー行なので2行目から取得
+        ranges = ['A{}:{}{}'.format(start, last_col, min(start + batch_rows - 1, worksheet.row_count)) for start in range(2, worksheet.row_count + 1, batch_rows)]
+        # 複数の範囲をbatchGetでまとめて取得する
+        ranges_per_request = int(self.spreadsheet.get('ranges_per_request', 1))
+        for request_ranges in myutil.iter_chunks(ranges, ranges_per_request):
+            with metrics.span('download', job=self.job_name):
+                values = self.get_values(worksheet, request_ranges)
+            for rows in values:
+                if not rows:
+                    continue
+                # 末尾の空セルは返ってこないので列数を揃える
+                rows = [row + [''] * (width - len(row)) for row in rows]
+                if self.snapshot:
+                    self.snapshot.append(rows)
+                metrics.incr('rows_fetched', len(rows), job=self.job_name)
+                yield rows
+
+    def get_values(self, worksheet, ranges):
+        # 1範囲ならget_values、複数範囲ならvalues:batchGetの1リクエストで取得
+        if len(ranges) == 1:
+            return [worksheet.get_values(ranges[0])]
+        return [list(values) for values in worksheet.batch_get(ranges)]
+
+    def iter_data(self, batch_rows=None):
+        for rows in self.iter_rows(batch_rows):
+            yield self.get_records(rows)
+
+    def get_records(self, rows):
+        rec_list = []
+        with metrics.span('transform', job=self.job_name):
+            converted = self.convert_columns(rows)
+            for i, row in enumerate(rows):
+                dict = {}
+                for info in self.spreadsheet['pair']:
+                    dict[info['col']] = converted[info['col']][i] if info['col'] in converted else row[int(info['idx'])]
+                rec_list.append(dict)
         return rec_list
-    
+
+    def get_transform_options(self):
+        # 行単位の変換をプロセスプールで行う並列数(2未満は同じプロセスで変換)と1タスクあたりの行数
+        return int(self.spreadsheet.get('transform_workers', 0)), int(self.spreadsheet.get('transform_chunk_rows', 10000))
+
+    def convert_columns(self, rows):
+        u"""
+        pairのtransformに指定した変換を列単位で行い、列名→変換後の値のリストを返す
+        """
+        transforms = {}
+        columns = {}
+        for info in self.spreadsheet['pair']:
+            names = myutil.get_transform_names(info.get('transform'))
+            if names:
+                transforms[info['col']] = names
+                columns[info['col']] = [row[int(info['idx'])] for row in rows]
+        if not transforms:
+            return {}
+        workers, chunk_rows = self.get_transform_options()
+        return myutil.map_column_transforms(columns, transforms, workers, chunk_rows)
+
+    def iter_frames(self, batch_rows=None):
+        u"""
+        iter_rowsのバッチを型変換済みのDataFrameで返す
+        """
+        for rows in self.iter_rows(batch_rows):
+            yield self.get_frame(rows)
+
+    def get_frame(self, rows):
+        import transform
+        workers, chunk_rows = self.get_transform_options()
+        with metrics.span('transform', job=self.job_name):
+            return transform.to_frame(rows, self.spreadsheet['pair'], self.table, workers, chunk_rows)
+
+    def is_columnar(self):
+        # 列単位の変換(columnar)が既定。pythonを指定した場合は行毎のdictで返す
+        return self.spreadsheet.get('transform', 'columnar') == 'columnar'
+
+    def transform_rows(self, rows):
+        # iter_batchesと同じ変換をiter_rowsの1バッチ分行う
+        if self.is_columnar():
+            return self.get_frame(rows)
+        return self.get_records(rows)
+
+    def iter_batches(self, batch_rows=None):
+        if self.is_columnar():
+            return self.iter_frames(batch_rows)
+        return self.iter_data(batch_rows)
+
     def insert_data(self, data, db_name):
-        self.create_table(db_name)
+        with metrics.span('insert_data', job=self.job_name):
+            return self.insert_batches([data], db_name)
+
+    def insert_batches(self, batches, db_name):
+        u"""
+        iter_dataのバッチを順にロードする。差分同期以外はバッチ単位でロードするため全件をメモリに持たない
+        """
+        sync = self.load_config.get('sync')
+        # マージを指定したテーブルはTRUNCATEせず既存の行にマージする
+        if self.get_merge() and sync != 'delta':
+            sync = 'merge'
+        # 書き込まない場合はDBへ接続しない(テーブルの作成・変更もしない)
+        if not self.insert_mode:
+            count = sum([len(batch) for batch in batches])
+            self.output_log('insert_list:' + str(count))
+            self.output_log('Skipped insert data.')
+            return count
+        with metrics.span('create_table', job=self.job_name):
+            # インデックスを後から作成する場合は主キーのみで作成
+            # swapでは稼働中のテーブルは入れ替えるだけなので、ALTER TABLEでロックを取らないよう無ければ作成するだけにする
+            self.create_table(db_name, with_index=not (self.is_defer_index() and sync != 'delta'), migrate=sync != 'swap')
         # Table Format(Column)
-        col_list = [info['col'] for info in CONFIG['spreadsheet']['pair']]
+        col_list = [info['col'] for info in self.spreadsheet['pair']]
         now = dt.today()
         str_now = now.strftime("%Y-%m-%d %H:%M:%S")
-        insert_list = []
-        for d in data:
-            list = []
-            for col in col_list:
-                list.append(d[col])
-            insert_list.append(list)
         # レコード作成日時設定
-        col_list.append("created")
-        for insert in insert_list:
-            insert.append(str_now)
-        pprint(insert_list)
-        self.output_log('insert_list:' + str(len(insert_list)))
-        # INSERT
-        if self.insert_mode:
-            db_config={}
-            db_config['host'] = 'localhost'
-            db_config['port'] = 3366
-            db_config['db'] = db_name
-            db_config['user'] = 'root'
-            db_config['pass'] = 'root'
-            analytics_db = db.AnalyticsDB(config=db_config)
-            #analytics_db.db_host = self.db_host
-            analytics_db.do_sql("TRUNCATE TABLE " + analytics_db.with_scheme(self.table['name'])) # Rset Table
-            result = analytics_db.insert_many_iferr_switch_insert(self.table['name'], col_list, insert_list)
-            self.output_log('Insert Results:' + str(result))
+        insert_col_list = col_list + ["created"]
+        analytics_db = self.get_db(db_name)
+        count = 0
+        if sync == 'delta':
+            insert_list = rowstore.RowStore(insert_col_list)
+            for batch in batches:
+                with metrics.span('row_mapping', job=self.job_name):
+                    insert_list.extend(self.get_insert_list(batch, col_list, str_now))
+            count = len(insert_list)
+            self.output_log('insert_list:' + str(count))
+            with metrics.span('delta', job=self.job_name):
+                result = self.sync_delta(analytics_db, insert_col_list, insert_list)
         else:
-            self.output_log('Skipped insert data.')
+            with metrics.span('prepare', job=self.job_name):
+                target_table = self.begin_load(analytics_db, db_name, sync)
+            result = []
+            try:
+                # インデックスを後から作成する場合はユニーク・外部キーのチェックを止めた1つの接続でロードする
+                with analytics_db.session(**(db.RELAXED_CHECKS if self.is_defer_index() else {})):
+                    for batch in batches:
+                        with metrics.span('row_mapping', job=self.job_name):
+                            insert_list = self.get_insert_list(batch, col_list, str_now)
+                        count += len(insert_list)
+                        with metrics.span('load', job=self.job_name):
+                            if sync == 'merge':
+                                result.append(self.merge_batch(analytics_db, target_table, insert_col_list, insert_list))
+                            else:
+                                result.append(analytics_db.load(target_table, insert_col_list, insert_list))
+            except BaseException:
+                # ロードに失敗したらインデックス作成・入れ替えは行わない
+                self.abort_load(analytics_db, target_table, sync)
+                raise
+            self.output_log('insert_list:' + str(count))
+            with metrics.span('finalize', job=self.job_name):
+                self.end_load(analytics_db, target_table, sync)
+        self.output_log('Insert Results:' + str(result))
+        return count
+
+    def is_defer_index(self):
+        u"""
+        テーブル定義のdefer_indexがtrueなら、セカンダリインデックスはロード後にまとめて作成する
+        マージではユニークキーのチェックが必要なため後回しにしない
+        """
+        return bool(self.table.get('defer_index')) and not self.get_merge()
 
+    def get_merge(self):
+        u"""
+        テーブル定義のmerge(strategy: update / ignore / replace、key: 重複を判定する列、update: 更新する列)を返す
+        strategyが未指定ならNone(TRUNCATEしてINSERTする)。keyの既定はシートのキー列
+        """
+        merge = self.table.get('merge') or {}
+        if not merge.get('strategy'):
+            return None
+        if merge['strategy'] not in db.MERGE_STRATEGIES:
+            raise ValueError('unknown merge strategy: ' + str(merge['strategy']))
+        return {
+            'strategy': merge['strategy'],
+            'key': merge.get('key') or self.spreadsheet['key'],
+            'update': merge.get('update') or [],
+        }
 
-def main(host, insert_mode, debug_mode, db_name):
+    def merge_batch(self, analytics_db, table_name, col_list, insert_list):
+        u"""
+        バッチをマージしてロードする。updateで更新する列の指定がなければキー列・作成日時以外の全列を更新する
+        """
+        merge = self.get_merge()
+        update_cols = merge['update'] or [col for col in col_list if col not in merge['key'] and col != 'created']
+        res = analytics_db.merge(table_name, col_list, insert_list, merge['strategy'], merge['key'], update_cols)
+        if 'errors' in res:
+            db.check_parallel_result(table_name, res)
+        return 'MERGE({}) Results: inserted:{} updated:{} unchanged:{} rejected:{} errors:{}'.format(
+            merge['strategy'], res.get('inserted', 0), res.get('updated', 0), res.get('unchanged', 0), res['rejected'], len(res.get('errors', [])))
+
+    def get_insert_list(self, data, col_list, str_now):
+        u"""
+        バッチをcol_list・作成日時の列を持つrowstore.RowStoreに変換する(作成日時は値を1つだけ持つ)
+        """
+        return self.to_store(data, col_list).add_constant('created', str_now)
+
+    def to_store(self, data, col_list):
+        if isinstance(data, rowstore.RowStore):
+            return rowstore.RowStore(col_list, [data.columns[data.col_list.index(col)] for col in col_list])
+        if is_frame(data):
+            return rowstore.RowStore.from_frame(data[col_list])
+        return rowstore.RowStore.from_records(col_list, data)
+
+    def begin_load(self, analytics_db, db_name, sync):
+        u"""
+        ロード先テーブルを準備して返す。swapでは <table>__staging を主キーのみで作成し、mergeでは行を消さずにそのまま返す
+        """
+        if sync == 'merge':
+            # 他の処理も書き込むテーブルのため行は消さない
+            if isinstance(analytics_db, db.SQLite):
+                raise ValueError('merge strategy is not supported on SQLite')
+            return self.table['name']
+        if sync == 'swap':
+            staging_table = self.table['name'] + '__staging'
+            analytics_db.drop_table(analytics_db.with_scheme(staging_table))
+            self.create_table(db_name, staging_table, with_index=False)
+            return staging_table
+        analytics_db.truncate_table(self.table['name']) # Rset Table
+        if self.is_defer_index():
+            analytics_db.drop_indexes(self.get_table_struct())
+        return self.table['name']
+
+    def abort_load(self, analytics_db, target_table, sync):
+        u"""
+        ロード失敗時の後始末。swapでは稼働中のテーブルはそのままにして <table>__staging を削除する
+        """
+        self.output_log('Load failed: ' + target_table)
+        if sync == 'swap':
+            analytics_db.drop_table(analytics_db.with_scheme(target_table))
+
+    def end_load(self, analytics_db, target_table, sync):
+        u"""
+        swapではインデックスをまとめて作成し、RENAME TABLEで稼働中のテーブルと入れ替える
+        swap以外でdefer_indexの場合は後回しにしたインデックスを作成する
+        """
+        if sync != 'swap':
+            # 後回しにしたインデックスを1回のALTER TABLEで作成
+            if self.is_defer_index():
+                migration = analytics_db.migrate_table(self.get_table_struct())
+                if migration:
+                    self.output_log('SQL: ' + migration['sql'])
+            return
+        table_name = self.table['name']
+        old_table = table_name + '__old'
+        # インデックスはデータ投入後にまとめて作成
+        index_sql = db.get_sql_for_add_index(self.get_table_struct(target_table))
+        if index_sql:
+            self.output_log('SQL: ' + index_sql)
+            analytics_db.do_sql(index_sql)
+        analytics_db.drop_table(analytics_db.with_scheme(old_table))
+        analytics_db.swap_table(table_name, target_table, old_table)
+        if not self.load_config.get('keep_old'):
+            analytics_db.drop_table(analytics_db.with_scheme(old_table))
+
+    def sync_delta(self, analytics_db, col_list, insert_list):
+        u"""
+        キー列で行を突き合わせ、状態テーブルに保持した行ハッシュと比較して変更分だけを反映する
+        """
+        # 差分同期はUPSERT・キー指定の削除を使うためMariaDBのみ
+        if isinstance(analytics_db, db.SQLite):
+            raise ValueError('delta sync is not supported on SQLite')
+        key_cols = self.spreadsheet['key']
+        key_idx = [col_list.index(col) for col in key_cols]
+        # 作成日時は最初に追加した日時のまま更新しない
+        update_cols = [col for col in col_list if col not in key_cols and col != 'created']
+        state_table = db.get_sync_state_table(self.table['name'])
+        analytics_db.create_table(state_table)
+        state = {}
+        for rec in analytics_db.fetch_all("SELECT row_key, row_hash, key_data FROM " + analytics_db.with_scheme(state_table['name'])):
+            state[rec['row_key']] = rec
+        # 同じキーの行が複数あれば後の行を優先(行はinsert_list(RowStore)の位置で持つ)
+        rows = {}
+        for i, insert in enumerate(insert_list):
+            rows[myutil.row_hash([insert[idx] for idx in key_idx])] = i
+        upsert_index = []
+        state_list = []
+        new_keys = set()
+        for row_key, i in rows.items():
+            insert = insert_list[i]
+            # 作成日時(末尾)は比較対象外
+            hash_value = myutil.row_hash(insert[:-1])
+            if row_key in state and state[row_key]['row_hash'] == hash_value:
+                continue
+            if row_key not in state:
+                new_keys.add(row_key)
+            upsert_index.append(i)
+            state_list.append([row_key, json.dumps([insert[idx] for idx in key_idx], ensure_ascii=False), hash_value])
+        deleted = [row_key for row_key in state.keys() if row_key not in rows]
+        upsert_list = insert_list.take(upsert_index)
+        rejected_keys = set()
+        if upsert_list:
+            res = analytics_db.bulk_insert(self.table['name'], col_list, upsert_list, update_cols)
+            # 隔離された行は状態テーブルに入れず、次回も変更ありとして再反映する
+            rejected_keys = set([myutil.row_hash([row[idx] for idx in key_idx]) for row in res.get('rejected_rows', [])])
+            state_list = [state_row for state_row in state_list if state_row[0] not in rejected_keys]
+        if deleted:
+            analytics_db.delete_by_keys(self.table['name'], key_cols, [json.loads(state[row_key]['key_data']) for row_key in deleted])
+        # 対象テーブルへの反映後に状態テーブルを更新する(途中で失敗しても次回の再反映で整合する)
+        if state_list:
+            analytics_db.bulk_insert(state_table['name'], ['row_key', 'key_data', 'row_hash'], state_list, ['key_data', 'row_hash'])
+        if deleted:
+            analytics_db.delete_by_keys(state_table['name'], ['row_key'], [[row_key] for row_key in deleted])
+        inserted = len(new_keys - rejected_keys)
+        return 'DELTA Results: inserted:{} updated:{} deleted:{} unchanged:{} rejected:{}'.format(
+            inserted, len(upsert_list) - len(rejected_keys) - inserted, len(deleted), len(rows) - len(upsert_list), len(rejected_keys))
+
+
+def configure_log():
+    config = get_config()
+    myutil.configure_log(
+        format=config.get('LOG_FORMAT'),
+        max_bytes=config.get('LOG_MAX_BYTES'),
+        backup_count=config.get('LOG_BACKUP_COUNT'))
+
+
+def get_log_file():
+    return os.path.dirname(__file__) + '/' + get_config()['LOG_FILE']
+
+
+def write_metrics():
+    for path in metrics.write(get_config().get('metrics'), os.path.dirname(__file__) or None):
+        print('metrics: ' + path)
+
+
+def get_cache():
+    if not get_config().get('cache', {}).get('enabled'):
+        return None
+    return sheetcache.SheetCache(dict(get_config()['cache'], exec_dir=os.path.dirname(__file__) or None))
+
+
+def begin_sync(sheet, cache=None, refresh=False, db_name=None):
+    u"""
+    同じロード先へキャッシュ済みの版から更新がなければFalseを返す。キャッシュ有効時は取得した行を書き込むスナップショットを開始する
+    """
+    if not cache:
+        return True
+    revision = sheet.get_revision()
+    target = sheet.get_cache_target(db_name)
+    if not refresh and cache.is_fresh(sheet.sheet_key, sheet.spreadsheet['name'], revision, target):
+        sheet.output_log('Skipped: sheet is not modified since ' + str(revision))
+        return False
+    sheet.snapshot = cache.begin(sheet.sheet_key, sheet.spreadsheet['name'], revision, target)
+    return True
+
+
+def end_sync(sheet, rows, cache=None):
+    # DBへ書き込んだ場合のみキャッシュを有効にする
+    if cache and sheet.snapshot and sheet.insert_mode:
+        cache.commit(sheet.snapshot, rows)
+
+
+def sync_sheet(sheet, db_name, cache=None, refresh=False):
+    u"""
+    シートを取得してDBへロードする。キャッシュ済みの版から更新がなければ取得・ロードとも行わない
+    """
+    if not begin_sync(sheet, cache, refresh, db_name):
+        return 0
+    # シートの取得とDBへのロードを並行させる
+    with metrics.span('sync', job=sheet.job_name):
+        rows = sheet.insert_batches(myutil.prefetch(sheet.iter_batches()), db_name)
+    end_sync(sheet, rows, cache)
+    return rows
+
+
+def main(host, insert_mode, debug_mode, db_name, refresh=False):
     # ログファイル初期化
-    myutil.clear_log_file(os.path.dirname(__file__) + '/' + CONFIG['LOG_FILE'])
-    sheet = SpreadSheet(host, insert_mode, debug_mode)
-    data = sheet.get_data()
-    sheet.insert_data(data, db_name)
+    configure_log()
+    myutil.clear_log_file(get_log_file())
+    metrics.reset()
+    try:
+        with metrics.span('main'):
+            sheet = SpreadSheet(host, insert_mode, debug_mode)
+            sync_sheet(sheet, db_name, get_cache(), refresh)
+    finally:
+        db.close_pools()
+        write_metrics()
+
+
+def export_data(db_name, client=None):
+    u"""
+    config.jsonのexportに指定したクエリの結果をワークシートへ書き出す(DB→シート)
+    """
+    config = get_config()['export']
+    client = client or get_client()
+    worksheet = client.open_by_key(config['spreadsheet_id']).worksheet(config['worksheet'])
+    try:
+        return export.export_query(get_db(db_name, get_config().get('load')), config['sql'], worksheet, int(config.get('batch_rows', 1000)),
+            net_write_timeout=config.get('net_write_timeout'))
+    finally:
+        db.close_pools()
+
+
+def run_jobs(jobs, host, insert_mode, debug_mode, workers=4, client=None, refresh=False):
+    u"""
+    ジョブ一覧(シート→テーブルの組)をスレッドプールで並列に実行し、ジョブ毎の処理時間・件数を返す
+    """
+    configure_log()
+    myutil.clear_log_file(get_log_file())
+    metrics.reset()
+    with metrics.span('auth'):
+        client = client or get_client()
+    cache = get_cache()
+    def run(job):
+        start = time.perf_counter()
+        res = {'name': job.get('name', job.get('table', get_config()['table'])['name']), 'rows': 0, 'sec': 0.0, 'error': None}
+        try:
+            sheet = SpreadSheet(host, debug_mode, insert_mode, client=client, job=job)
+            res['rows'] = sync_sheet(sheet, job.get('db_name', get_config()['DB_NAME']), cache, refresh)
+        except Exception as e:
+            res['error'] = repr(e)
+            metrics.incr('job_errors', job=res['name'])
+        res['sec'] = round(time.perf_counter() - start, 3)
+        return res
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            summary = list(executor.map(run, jobs))
+    finally:
+        db.close_pools()
+        write_metrics()
+    for res in summary:
+        print('{name}: {rows} rows, {sec} sec{}'.format(', ERROR: ' + res['error'] if res['error'] else '', **res))
+    return summary
 
 
 if __name__ == '__main__':
@@ -135,12 +574,18 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", help="optional. デバッグメッセージを出力.", action="store_true")
     parser.add_argument("--insert", help="optional. インサート処理を行うか.", action="store_true")
+    parser.add_argument("--jobs", help="optional. ジョブ定義ファイル(複数シート→テーブルを並列実行).")
+    parser.add_argument("--workers", help="optional. ジョブの並列数.", type=int)
+    parser.add_argument("--refresh", help="optional. キャッシュを無視してシートを再取得.", action="store_true")
+    parser.add_argument("--export", help="optional. exportのクエリ結果をシートへ書き出す(DB→シート).", action="store_true")
+    parser.add_argument("--async", dest="use_async", help="optional. 取得・変換・ロードをasyncioで並行実行(複数シートは1つのイベントループで実行).", action="store_true")
     args = parser.parse_args()
     # コンフィグ読み込み
-    host = CONFIG['DB_HOST']
-    debug_mode = CONFIG['DEBUG_MODE']
-    insert_mode = CONFIG['INSERT_MODE']
-    db_name = CONFIG['DB_NAME']
+    config = get_config()
+    host = config['DB_HOST']
+    debug_mode = config['DEBUG_MODE']
+    insert_mode = config['INSERT_MODE']
+    db_name = config['DB_NAME']
     # プログラムオプション設定
     if args.debug:
         debug_mode = True
@@ -149,4 +594,22 @@ if __name__ == '__main__':
     print("Debug-mode: " + str(debug_mode))
     print("Insert-mode: " + str(insert_mode))
     print("DB-Name: " + str(db_name))
-    main(host, debug_mode, insert_mode, db_name)
+    if args.export:
+        export_data(db_name)
+    elif args.use_async:
+        import asyncio
+        import pipeline
+        manifest = {'jobs': [{}]}
+        if args.jobs:
+            with open(args.jobs, encoding="utf-8") as f:
+                manifest = json.load(f)
+        pipeline_config = config.get('pipeline', {})
+        asyncio.run(pipeline.run_many(manifest['jobs'], host, insert_mode, debug_mode,
+            args.workers or manifest.get('workers', pipeline_config.get('concurrency', 4)),
+            refresh=args.refresh, queue_size=int(pipeline_config.get('queue_size', 2))))
+    elif args.jobs:
+        with open(args.jobs, encoding="utf-8") as f:
+            manifest = json.load(f)
+        run_jobs(manifest['jobs'], host, insert_mode, debug_mode, args.workers or manifest.get('workers', 4), refresh=args.refresh)
+    else:
+        main(host, debug_mode, insert_mode, db_name, args.refresh)
@@ -0,0 +1,161 @@
+"""
+===============================================================================>
+
+計測ライブラリ(処理段階毎の時間・行数などのカウンター)
+
+===============================================================================>
+"""
+import json
+import os
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime as dt
+from functools import wraps
+
+
+class Metrics:
+    u"""
+    段階(span)毎の実行回数・累計時間と、行数・バイト数などのカウンターを集計する(スレッド間で共有可)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.spans = {}
+            self.counters = {}
+            self.started = time.time()
+
+    def get_key(self, name, labels):
+        return (name, tuple(sorted([(k, str(v)) for k, v in labels.items()])))
+
+    def observe(self, name, sec, **labels):
+        key = self.get_key(name, labels)
+        with self.lock:
+            span = self.spans.setdefault(key, {'count': 0, 'sec': 0.0, 'max': 0.0})
+            span['count'] += 1
+            span['sec'] += sec
+            span['max'] = max(span['max'], sec)
+
+    @contextmanager
+    def span(self, name, **labels):
+        # 入れ子のspanはそれぞれ内側の時間を含めて計測する
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def incr(self, name, value=1, **labels):
+        key = self.get_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def summary(self):
+        with self.lock:
+            return {
+                'started': dt.fromtimestamp(self.started).strftime("%Y-%m-%d %H:%M:%S"),
+                'sec': round(time.time() - self.started, 3),
+                'spans': [
+                    {'name': name, 'labels': dict(labels), 'count': span['count'], 'sec': round(span['sec'], 6), 'max': round(span['max'], 6)}
+                    for (name, labels), span in sorted(self.spans.items())
+                ],
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+            }
+
+    def to_prometheus(self, prefix='sheet2db'):
+        u"""
+        node_exporterのtextfile collectorで読めるPrometheusのテキスト形式に変換する
+        """
+        summary = self.summary()
+        lines = [
+            '# HELP {}_stage_seconds_total Time spent in each stage.'.format(prefix),
+            '# TYPE {}_stage_seconds_total counter'.format(prefix),
+        ]
+        for span in summary['spans']:
+            lines.append('{}_stage_seconds_total{} {}'.format(prefix, format_labels(dict(span['labels'], stage=span['name'])), span['sec']))
+        lines += [
+            '# HELP {}_stage_calls_total Number of times each stage ran.'.format(prefix),
+            '# TYPE {}_stage_calls_total counter'.format(prefix),
+        ]
+        for span in summary['spans']:
+            lines.append('{}_stage_calls_total{} {}'.format(prefix, format_labels(dict(span['labels'], stage=span['name'])), span['count']))
+        names = []
+        for counter in summary['counters']:
+            metric = '{}_{}_total'.format(prefix, counter['name'])
+            if counter['name'] not in names:
+                names.append(counter['name'])
+                lines.append('# TYPE {} counter'.format(metric))
+            lines.append('{}{} {}'.format(metric, format_labels(counter['labels']), counter['value']))
+        lines += [
+            '# HELP {}_last_run_timestamp_seconds Time the run started.'.format(prefix),
+            '# TYPE {}_last_run_timestamp_seconds gauge'.format(prefix),
+            '{}_last_run_timestamp_seconds {}'.format(prefix, round(self.started, 3)),
+            '# TYPE {}_last_run_duration_seconds gauge'.format(prefix),
+            '{}_last_run_duration_seconds {}'.format(prefix, summary['sec']),
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in sorted(labels.items())]
+    return '{' + ','.join(escaped) + '}'
+
+
+# プロセス全体で共有する計測値
+METRICS = Metrics()
+
+def span(name, **labels):
+    return METRICS.span(name, **labels)
+
+def incr(name, value=1, **labels):
+    METRICS.incr(name, value, **labels)
+
+def reset():
+    METRICS.reset()
+
+def summary():
+    return METRICS.summary()
+
+def timed(name):
+    u"""
+    関数・メソッドの実行時間をnameのspanとして計測するデコレーター
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with METRICS.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def write_file(path, text):
+    # 書き込み途中のファイルを読まれないよう一時ファイルから置き換える
+    tmp_file = path + '.tmp'
+    with open(tmp_file, mode='w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_file, path)
+
+def write(config=None, exec_dir=None):
+    u"""
+    config(json_file・prom_file)に従って集計結果をJSON・Prometheusのテキスト形式で書き出す
+    """
+    config = config or {}
+    written = []
+    for key, to_text in (('json_file', lambda: json.dumps(summary(), ensure_ascii=False, indent=2)), ('prom_file', lambda: METRICS.to_prometheus(config.get('prefix', 'sheet2db')))):
+        path = config.get(key)
+        if not path:
+            continue
+        if exec_dir and not os.path.isabs(path):
+            path = os.path.join(exec_dir, path)
+        write_file(path, to_text())
+        written.append(path)
+    return written
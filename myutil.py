@@ -9,28 +9,146 @@ from datetime import datetime as dt
 from datetime import date, timedelta
 from dateutil import tz
 import json
-import yaml
 import os
+import hashlib
+import sys
+import atexit
+import queue
+import threading
+from operator import itemgetter
+from itertools import islice
+from functools import lru_cache
+
+# ログ出力設定(format: text / json、ローテーションするサイズと世代数、1件あたりの最大文字数)
+LOG_OPTIONS = {
+    'format': 'text',
+    'max_bytes': 10 * 1024 * 1024,
+    'backup_count': 3,
+    'max_msg_len': 1000,
+}
+LOG_WRITERS = {}
+LOG_WRITERS_LOCK = threading.Lock()
+
+def configure_log(**options):
+    LOG_OPTIONS.update({k: v for k, v in options.items() if v is not None})
+
+"""
+ログ書き込みスレッド
+キューに溜めたログをまとめて書き出し、max_bytesを超えたらローテーションする
+"""
+class LogWriter:
+
+    def __init__(self, log_file, max_bytes=0, backup_count=0, flush_interval=1.0, buffer_size=1000):
+        self.log_file = log_file
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, line):
+        self.queue.put(line)
+
+    def run(self):
+        while True:
+            lines = [self.queue.get()]
+            # flush_interval秒待つ間に来たログはまとめて書き出す
+            try:
+                while len(lines) < self.buffer_size:
+                    lines.append(self.queue.get(timeout=self.flush_interval if len(lines) == 1 else 0))
+            except queue.Empty:
+                pass
+            stop = None in lines
+            try:
+                self.write_lines([line for line in lines if line is not None])
+            except Exception as e:
+                # 書き込めなくてもスレッドは止めず、標準エラーに出してflush待ちを解放する
+                sys.stderr.write('log write failed: {}: {}\n'.format(self.log_file, e))
+                sys.stderr.write(''.join(line for line in lines if line is not None))
+            finally:
+                for line in lines:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def write_lines(self, lines):
+        if not lines:
+            return
+        data = ''.join(lines)
+        if self.max_bytes and os.path.exists(self.log_file) and os.path.getsize(self.log_file) + len(data) > self.max_bytes:
+            self.rotate()
+        with open(self.log_file, mode='a', encoding='utf-8') as f:
+            f.write(data)
+
+    def rotate(self):
+        if self.backup_count <= 0:
+            open(self.log_file, 'w').close()
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists('{}.{}'.format(self.log_file, i)):
+                os.replace('{}.{}'.format(self.log_file, i), '{}.{}'.format(self.log_file, i + 1))
+        os.replace(self.log_file, self.log_file + '.1')
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+def get_log_writer(log_file):
+    with LOG_WRITERS_LOCK:
+        if log_file not in LOG_WRITERS:
+            LOG_WRITERS[log_file] = LogWriter(log_file, LOG_OPTIONS['max_bytes'], LOG_OPTIONS['backup_count'])
+        return LOG_WRITERS[log_file]
+
+def flush_log(log_file=None):
+    for key, writer in list(LOG_WRITERS.items()):
+        if log_file is None or key == log_file:
+            writer.flush()
+
+def close_log_writers():
+    with LOG_WRITERS_LOCK:
+        for writer in LOG_WRITERS.values():
+            writer.close()
+        LOG_WRITERS.clear()
+
+atexit.register(close_log_writers)
+
+def summarize(msg, max_len=1000):
+    u"""
+    ログ用に大きなデータを要約する(リストは件数と先頭3件、長い文字列は先頭max_len文字)
+    """
+    if isinstance(msg, (list, tuple)) and len(msg) > 3:
+        return {'type': 'list', 'len': len(msg), 'head': [summarize(m, max_len) for m in msg[:3]]}
+    if isinstance(msg, str) and len(msg) > max_len:
+        return msg[:max_len] + '...({} chars)'.format(len(msg))
+    if isinstance(msg, dict):
+        return {k: summarize(v, max_len) for k, v in msg.items()}
+    return msg
 
 # ログファイル初期化
 def clear_log_file(log_file):
+    flush_log(log_file)
     with open(log_file, 'w') as f:
         f.write('')
 
-# ログ出力
+# ログ出力(書き込みはLogWriterのスレッドで行う)
 def output_log(log_file, msg, log_sign='[+]', debug_mode=False):
-    if isinstance(msg, list) or isinstance(msg, dict):
-        if debug_mode:
-            print(msg)
-        if log_file:
-            with open(log_file, mode='a') as f:
-                f.write(log_date() + ' ' + log_sign + ' ' + json.dumps(msg) + '\n')
+    msg = summarize(msg, LOG_OPTIONS['max_msg_len'])
+    if debug_mode:
+        print(log_sign + ' ' + msg if isinstance(msg, str) else msg)
+    if not log_file:
+        return
+    if LOG_OPTIONS['format'] == 'json':
+        line = json.dumps({'time': log_date()[1:-1], 'sign': log_sign, 'msg': msg}, ensure_ascii=False, default=str)
+    elif isinstance(msg, str):
+        line = log_date() + ' ' + log_sign + ' ' + msg
     else:
-        if debug_mode:
-            print(log_sign + ' ' + msg)
-        if log_file:
-            with open(log_file, mode='a') as f:
-                f.write(log_date() + ' ' + log_sign + ' ' + msg + '\n')
+        line = log_date() + ' ' + log_sign + ' ' + json.dumps(msg, default=str)
+    get_log_writer(log_file).write(line + '\n')
 
 # ログ日時フォーマット
 def log_date():
@@ -39,6 +157,7 @@ def log_date():
 
 # コンフィグファイルのロード
 def load_config(config_file):
+    import yaml
     with open(config_file, encoding="utf-8") as f:
         return yaml.safe_load(f)
 
@@ -54,6 +173,84 @@ def slice_list(list, n):
         res.append(list[i: i+n])
     return res
 
+def row_hash(values) -> str:
+    u"""
+    行の値からハッシュ値(sha1)を作成
+    """
+    return hashlib.sha1(json.dumps(values, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+def col_to_a1(col: int) -> str:
+    u"""
+    列番号(1始まり)をA1形式の列名に変換
+    """
+    name = ''
+    while col > 0:
+        col, rem = divmod(col - 1, 26)
+        name = chr(ord('A') + rem) + name
+    return name
+
+def a1_to_col(name: str) -> int:
+    u"""
+    A1形式の列名を列番号(1始まり)に変換
+    """
+    col = 0
+    for c in name.upper():
+        col = col * 26 + ord(c) - ord('A') + 1
+    return col
+
+def prefetch(iterable, depth=1):
+    u"""
+    別スレッドでiterableを先読みする。取得側と処理側を並行させる(先読みはdepth件まで)
+    処理側が途中でやめた場合(例外・close)は先読みを止め、iterableもcloseする
+    """
+    q = queue.Queue(maxsize=depth)
+    end = object()
+    stop = threading.Event()
+    def put(entry):
+        # キューが空くのを待つ間も処理側がやめていないか確かめる
+        while not stop.is_set():
+            try:
+                q.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def producer():
+        it = iter(iterable)
+        try:
+            for item in it:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((None, e))
+            return
+        finally:
+            if hasattr(it, 'close'):
+                it.close()
+        put((end, None))
+    threading.Thread(target=producer, daemon=True).start()
+    try:
+        while True:
+            item, err = q.get()
+            if err:
+                raise err
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
+
+def iter_chunks(iterable, n):
+    u"""
+    iterableをn件ずつのリストに分けて返す(リスト以外のiterableにも使える)
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
 def file_list_on_dir(path: str):
     files = os.listdir(path)
     return [f for f in files if os.path.isfile(os.path.join(path, f))]
@@ -62,12 +259,40 @@ def dir_list_on_dir(path: str):
     files = os.listdir(path)
     return [f for f in files if os.path.isdir(os.path.join(path, f))]
 
+@lru_cache(maxsize=None)
+def get_tz(name):
+    u"""
+    tz.gettzの結果をキャッシュする(呼び出し毎にタイムゾーンを解決しない)
+    """
+    return tz.gettz(name)
+
+# ISO8601以外で受け付ける日時の書式
+DATETIME_FORMATS = ('%Y/%m/%d %H:%M:%S', '%Y/%m/%d %H:%M', '%Y/%m/%d')
+
+def parse_utc(value) -> dt:
+    u"""
+    日時の文字列をUTCの日時(タイムゾーンなし)に変換する。タイムゾーンなしの値はUTCとみなす(transform.to_datetimeと同じ)
+    """
+    value = value.strip()
+    try:
+        parsed = dt.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        for format in DATETIME_FORMATS:
+            try:
+                parsed = dt.strptime(value, format)
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError('invalid datetime: ' + value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(tz.UTC).replace(tzinfo=None)
+    return parsed
+
 # UTC⇒JST変換
 def cnv_utc_to_jst(utc) -> str:
-    utc = utc.replace('Z', '+00:00')
-    dt_utc = dt.fromisoformat(utc)
-    JST = tz.gettz('Asia/Tokyo')
-    dt_jst = dt_utc.astimezone(JST)
+    dt_utc = parse_utc(utc).replace(tzinfo=tz.UTC)
+    dt_jst = dt_utc.astimezone(get_tz('Asia/Tokyo'))
     return dt_jst.strftime('%Y-%m-%d %H:%M:%S')
 
 def get_insert_col_list(table_struct):
@@ -97,10 +322,11 @@ def get_insert_data_list(col_list, data_list):
         print('list data is empty.')
         print(data_list)
         return []
-    insert_list = []
-    for data in data_list:
-        insert_list.append(get_insert_data(col_list, data))
-    return insert_list
+    # 列の取り出しはitemgetterでまとめて行う
+    getter = itemgetter(*col_list)
+    if len(col_list) == 1:
+        return [[getter(data)] for data in data_list]
+    return [list(getter(data)) for data in data_list]
 
 def list2dict_by_key(list, key) -> dict:
     u"""
@@ -133,3 +359,76 @@ def get_last_sunday_before(date):
     dt_sunday = dt.strptime(sunday, '%Y-%m-%d')
     dt_sunday += timedelta(-7)
     return dt_sunday.strftime('%Y-%m-%d')
+
+def get_week_start(value):
+    # 日時の文字列はUTCの日付で週を求める
+    return get_sunday_of_the_week(parse_utc(value).strftime('%Y-%m-%d'))
+
+# config.jsonのpairで列毎に指定できる変換(行単位)。列単位(pandas)の実装はtransform.COLUMN_TRANSFORMS
+ROW_TRANSFORMS = {
+    'utc_to_jst': cnv_utc_to_jst,
+    'week_start': get_week_start,
+    'strip': str.strip,
+}
+
+def get_transform_names(transform):
+    # 変換は1つなら文字列、複数ならリストで指定(指定順に適用)
+    if not transform:
+        return []
+    return [transform] if isinstance(transform, str) else list(transform)
+
+def apply_row_transforms(names, values):
+    u"""
+    valuesに変換を順に適用したリストを返す。空文字・変換できない値はNone
+    """
+    funcs = [ROW_TRANSFORMS[name] for name in names]
+    result = []
+    for value in values:
+        if value is None or value == '':
+            result.append(None)
+            continue
+        try:
+            for func in funcs:
+                value = func(value)
+        except (ValueError, TypeError):
+            value = None
+        result.append(value)
+    return result
+
+PROCESS_POOLS = {}
+PROCESS_POOLS_LOCK = threading.Lock()
+
+def get_process_pool(workers):
+    u"""
+    変換用のプロセスプール(並列数毎に共有)。スレッドを使う処理と併用するためspawnで起動する
+    """
+    with PROCESS_POOLS_LOCK:
+        if workers not in PROCESS_POOLS:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            PROCESS_POOLS[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return PROCESS_POOLS[workers]
+
+def close_process_pools():
+    with PROCESS_POOLS_LOCK:
+        for pool in PROCESS_POOLS.values():
+            pool.shutdown()
+        PROCESS_POOLS.clear()
+
+atexit.register(close_process_pools)
+
+def map_column_transforms(columns, transforms, workers=0, chunk_rows=10000):
+    u"""
+    列名→値のリストのcolumnsに、列名→変換名のリストのtransformsを適用した列を返す
+    workersが2以上で行数がchunk_rowsを超える場合は、列をchunk_rows行ずつに分けてプロセスプールで変換する
+    """
+    result = {}
+    if workers > 1 and any([len(columns[col]) > chunk_rows for col in transforms]):
+        pool = get_process_pool(workers)
+        futures = {col: [pool.submit(apply_row_transforms, names, chunk) for chunk in iter_chunks(columns[col], chunk_rows)] for col, names in transforms.items()}
+        for col, chunk_futures in futures.items():
+            result[col] = [value for future in chunk_futures for value in future.result()]
+        return result
+    for col, names in transforms.items():
+        result[col] = apply_row_transforms(names, columns[col])
+    return result
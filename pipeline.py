@@ -0,0 +1,148 @@
+"""
+===============================================================================>
+
+asyncioパイプライン(シート取得・行変換・DBロードを並行実行)
+
+===============================================================================>
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import db
+import metrics
+import myutil
+import main
+
+# ステージ間のキューに流す終端
+END = object()
+
+
+class PipelineAborted(Exception):
+    u"""
+    他のステージが失敗したため処理を打ち切った
+    """
+    pass
+
+
+async def race(coro, abort):
+    u"""
+    coroの完了を待つ。先にabortが立った場合はPipelineAbortedを送出する
+    """
+    task = asyncio.ensure_future(coro)
+    stop = asyncio.ensure_future(abort.wait())
+    done, pending = await asyncio.wait([task, stop], return_when=asyncio.FIRST_COMPLETED)
+    for future in pending:
+        future.cancel()
+    if task in done:
+        return task.result()
+    raise PipelineAborted()
+
+
+async def fetch_stage(sheet, out_queue, abort):
+    # シートの取得(API呼び出し)はスレッドで行い、キューが埋まっていれば次の取得を待つ
+    rows_iter = sheet.iter_rows()
+    while True:
+        rows = await asyncio.to_thread(next, rows_iter, END)
+        if rows is END:
+            break
+        await race(out_queue.put(rows), abort)
+    await race(out_queue.put(END), abort)
+
+
+async def transform_stage(sheet, in_queue, out_queue, abort):
+    while True:
+        rows = await race(in_queue.get(), abort)
+        if rows is END:
+            break
+        batch = await asyncio.to_thread(sheet.transform_rows, rows)
+        await race(out_queue.put(batch), abort)
+    await race(out_queue.put(END), abort)
+
+
+def iter_queue(in_queue, loop, abort):
+    u"""
+    ロード用スレッドからイベントループのキューを順に読み出す
+    """
+    while True:
+        batch = asyncio.run_coroutine_threadsafe(race(in_queue.get(), abort), loop).result()
+        if batch is END:
+            return
+        yield batch
+
+
+async def load_stage(sheet, db_name, in_queue, abort):
+    u"""
+    insert_batchesを専用スレッドで実行する(session()で固定した接続を同じスレッドで使い続けるため)
+    """
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return await loop.run_in_executor(executor, sheet.insert_batches, iter_queue(in_queue, loop, abort), db_name)
+
+
+async def run_stage(coro, abort):
+    # 失敗したら他のステージを止める
+    try:
+        return await coro
+    except BaseException:
+        abort.set()
+        raise
+
+
+async def sync_sheet(sheet, db_name, cache=None, refresh=False, queue_size=2):
+    u"""
+    main.sync_sheetのasyncio版。取得・変換・ロードをqueue_size件までのキューでつないで並行させ、ロードした行数を返す
+    """
+    if not await asyncio.to_thread(main.begin_sync, sheet, cache, refresh, db_name):
+        return 0
+    abort = asyncio.Event()
+    rows_queue = asyncio.Queue(maxsize=queue_size)
+    batch_queue = asyncio.Queue(maxsize=queue_size)
+    with metrics.span('sync', job=sheet.job_name):
+        results = await asyncio.gather(
+            run_stage(fetch_stage(sheet, rows_queue, abort), abort),
+            run_stage(transform_stage(sheet, rows_queue, batch_queue, abort), abort),
+            run_stage(load_stage(sheet, db_name, batch_queue, abort), abort),
+            return_exceptions=True)
+    # 打ち切られたステージではなく、最初に失敗したステージの例外を返す
+    errors = [res for res in results if isinstance(res, BaseException)]
+    for error in errors:
+        if not isinstance(error, PipelineAborted):
+            raise error
+    if errors:
+        raise errors[0]
+    rows = results[-1]
+    await asyncio.to_thread(main.end_sync, sheet, rows, cache)
+    return rows
+
+
+async def run_many(jobs, host, insert_mode, debug_mode, concurrency=4, client=None, refresh=False, queue_size=2):
+    u"""
+    ジョブ一覧(シート→テーブルの組)を1つのイベントループでconcurrency件ずつ並行に実行し、ジョブ毎の処理時間・件数を返す
+    """
+    main.configure_log()
+    myutil.clear_log_file(main.get_log_file())
+    metrics.reset()
+    with metrics.span('auth'):
+        client = client or await asyncio.to_thread(main.get_client)
+    cache = main.get_cache()
+    semaphore = asyncio.Semaphore(concurrency)
+    async def run(job):
+        async with semaphore:
+            start = time.perf_counter()
+            res = {'name': job.get('name', job.get('table', main.get_config()['table'])['name']), 'rows': 0, 'sec': 0.0, 'error': None}
+            try:
+                sheet = await asyncio.to_thread(main.SpreadSheet, host, debug_mode, insert_mode, client, job)
+                res['rows'] = await sync_sheet(sheet, job.get('db_name', main.get_config()['DB_NAME']), cache, refresh, queue_size)
+            except Exception as e:
+                res['error'] = repr(e)
+                metrics.incr('job_errors', job=res['name'])
+            res['sec'] = round(time.perf_counter() - start, 3)
+            return res
+    try:
+        summary = await asyncio.gather(*[run(job) for job in jobs])
+    finally:
+        db.close_pools()
+        main.write_metrics()
+    for res in summary:
+        print('{name}: {rows} rows, {sec} sec{}'.format(', ERROR: ' + res['error'] if res['error'] else '', **res))
+    return summary
@@ -0,0 +1,248 @@
+"""
+===============================================================================>
+
+列指向の行コンテナ(ロード中のデータをメモリを抑えて保持する)
+
+===============================================================================>
+"""
+import math
+from array import array
+from itertools import repeat
+
+# 列毎に共有する文字列の最大種類数(これを超えた列は値の重複が少ないとみなして共有をやめる)
+INTERN_LIMIT = 65536
+
+
+class ObjectColumn:
+    u"""
+    任意の値の列。同じ文字列は1つのオブジェクトを共有する
+    """
+
+    def __init__(self, values=None):
+        self.values = []
+        self.interned = {}
+        if values is not None:
+            self.extend(values)
+
+    def append(self, value):
+        if isinstance(value, str) and self.interned is not None:
+            value = self.interned.setdefault(value, value)
+            if len(self.interned) > INTERN_LIMIT:
+                self.interned = None
+        self.values.append(value)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, i):
+        return self.values[i]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def take(self, indexes):
+        column = ObjectColumn()
+        column.values = [self.values[i] for i in indexes]
+        column.interned = None
+        return column
+
+
+class IntColumn:
+    u"""
+    整数の列(64bit)。NULLは別のバイト列で持つ
+    """
+
+    def __init__(self, values=None, nulls=None):
+        self.values = values if values is not None else array('q')
+        self.nulls = nulls if nulls is not None else bytearray(len(self.values))
+
+    def append(self, value):
+        self.nulls.append(value is None)
+        self.values.append(0 if value is None else value)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, i):
+        return None if self.nulls[i] else self.values[i]
+
+    def __iter__(self):
+        if not any(self.nulls):
+            return iter(self.values)
+        return (None if null else value for value, null in zip(self.values, self.nulls))
+
+    def take(self, indexes):
+        return IntColumn(array('q', [self.values[i] for i in indexes]), bytearray([self.nulls[i] for i in indexes]))
+
+
+class FloatColumn:
+    u"""
+    小数の列(倍精度)。NULLはNaNで持つ
+    """
+
+    def __init__(self, values=None):
+        self.values = values if values is not None else array('d')
+
+    def append(self, value):
+        self.values.append(math.nan if value is None else value)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, i):
+        value = self.values[i]
+        return None if math.isnan(value) else value
+
+    def __iter__(self):
+        return (None if math.isnan(value) else value for value in self.values)
+
+    def take(self, indexes):
+        return FloatColumn(array('d', [self.values[i] for i in indexes]))
+
+
+class ConstColumn:
+    u"""
+    全行が同じ値の列(作成日時など)。値を1つだけ持つ
+    """
+
+    def __init__(self, value, length=0):
+        self.value = value
+        self.length = length
+
+    def append(self, value):
+        if value != self.value:
+            raise ValueError('ConstColumn accepts only ' + repr(self.value))
+        self.length += 1
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def __len__(self):
+        return self.length
+
+    def get(self, i):
+        return self.value
+
+    def __iter__(self):
+        return repeat(self.value, self.length)
+
+    def take(self, indexes):
+        return ConstColumn(self.value, len(indexes))
+
+
+def concat_columns(column, other):
+    u"""
+    同じ種類の列はそのまま連結し、種類が違えばObjectColumnにまとめる
+    """
+    if not len(column):
+        return other
+    if type(column) is type(other):
+        if isinstance(column, IntColumn):
+            column.values.extend(other.values)
+            column.nulls.extend(other.nulls)
+            return column
+        if isinstance(column, FloatColumn):
+            column.values.extend(other.values)
+            return column
+        if isinstance(column, ConstColumn) and column.value == other.value:
+            column.length += other.length
+            return column
+        if isinstance(column, ObjectColumn):
+            column.extend(other.values)
+            return column
+    merged = ObjectColumn(column)
+    merged.extend(other)
+    return merged
+
+def from_series(series):
+    u"""
+    DataFrameの列を型に合った列に変換する(行毎のオブジェクトは作らない)
+    """
+    dtype = str(series.dtype)
+    if dtype in ('Int64', 'Int32', 'int64', 'int32'):
+        nulls = series.isna().to_numpy()
+        values = array('q')
+        values.frombytes(series.fillna(0).to_numpy(dtype='int64').tobytes())
+        return IntColumn(values, bytearray(nulls.astype('uint8').tobytes()))
+    if dtype in ('float64', 'Float64'):
+        values = array('d')
+        values.frombytes(series.to_numpy(dtype='float64', na_value=math.nan).tobytes())
+        return FloatColumn(values)
+    values = series.tolist()
+    if series.hasnans:
+        values = [None if value is None or (isinstance(value, float) and math.isnan(value)) else value for value in values]
+    return ObjectColumn(values)
+
+
+class RowStore:
+    u"""
+    列指向の行コンテナ。整数・小数の列はarray、文字列の列は同じ値を共有したリストで持つ
+    行はtupleで返すため、行のリストの代わりにMariaDB・SQLiteのバルクロードへそのまま渡せる(len・反復・スライスに対応)
+    """
+
+    def __init__(self, col_list, columns=None):
+        self.col_list = list(col_list)
+        self.columns = columns if columns is not None else [ObjectColumn() for col in self.col_list]
+
+    @classmethod
+    def from_records(cls, col_list, records):
+        u"""
+        行毎のdict(iter_dataのバッチ)から作成する
+        """
+        return cls(col_list, [ObjectColumn([record[col] for record in records]) for col in col_list])
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls(list(df.columns), [from_series(df[col]) for col in df.columns])
+
+    def add_constant(self, col, value):
+        u"""
+        全行が同じ値の列を追加して自身を返す
+        """
+        self.col_list.append(col)
+        self.columns.append(ConstColumn(value, len(self)))
+        return self
+
+    def append(self, row):
+        for column, value in zip(self.columns, row):
+            column.append(value)
+
+    def extend(self, rows):
+        if isinstance(rows, RowStore):
+            self.columns = [concat_columns(column, other) for column, other in zip(self.columns, rows.columns)]
+            return
+        for row in rows:
+            self.append(row)
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __iter__(self):
+        return zip(*self.columns)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.take(range(*key.indices(len(self))))
+        if key < 0:
+            key += len(self)
+        return tuple([column.get(key) for column in self.columns])
+
+    def take(self, indexes):
+        u"""
+        indexesの行だけを持つRowStoreを返す
+        """
+        indexes = list(indexes)
+        return RowStore(self.col_list, [column.take(indexes) for column in self.columns])
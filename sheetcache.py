@@ -0,0 +1,148 @@
+"""
+===============================================================================>
+
+スプレッドシート取得結果のキャッシュ(SQLite)
+
+===============================================================================>
+"""
+import json
+import threading
+from datetime import datetime as dt
+from datetime import timedelta
+import db
+
+SNAPSHOT_TABLE = {
+    'name': 'sheet_snapshot',
+    'columns': [
+        {'name': 'id', 'type': 'INTEGER', 'option': 'PRIMARY KEY AUTOINCREMENT'},
+        {'name': 'sheet_id', 'type': 'varchar(255)'},
+        {'name': 'worksheet', 'type': 'varchar(255)'},
+        {'name': 'target', 'type': 'varchar(255)'},
+        {'name': 'revision', 'type': 'varchar(255)'},
+        {'name': 'row_count', 'type': 'int(11)'},
+        {'name': 'status', 'type': 'varchar(16)'},
+        {'name': 'pulled_at', 'type': 'DATETIME'},
+    ]
+}
+
+CHUNK_TABLE = {
+    'name': 'sheet_snapshot_chunk',
+    'columns': [
+        {'name': 'snapshot_id', 'type': 'int(11)'},
+        {'name': 'chunk_no', 'type': 'int(11)'},
+        {'name': 'data', 'type': 'TEXT'},
+    ]
+}
+
+"""
+取得中のスナップショット。シートの行をチャンク単位で書き込む
+"""
+class Snapshot:
+
+    def __init__(self, cache, snapshot_id):
+        self.cache = cache
+        self.id = snapshot_id
+        self.chunk_no = 0
+
+    def append(self, rows):
+        self.chunk_no += 1
+        self.cache.append(self.id, self.chunk_no, rows)
+
+"""
+シートキャッシュ
+spreadsheet id・ワークシート名・ロード先(target)ごとに、最後に取得した内容とシートの更新日時(revision)を保持する
+targetはロード先のDB・テーブルと列の対応・テーブル定義のハッシュ(同じシートを別のテーブルへロードするジョブや、設定の変更を区別する)
+"""
+class SheetCache:
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.retention = int(config.get('retention', 3))
+        self.max_age_days = int(config.get('max_age_days', 30))
+        self.lock = threading.Lock()
+        self.db = db.SQLite(dict(SNAPSHOT_TABLE, db_file=config.get('db_file', 'sheet_cache.db')), config.get('exec_dir'))
+        self.db.create_table(SNAPSHOT_TABLE)
+        self.db.create_table(CHUNK_TABLE)
+        # target列がない古いキャッシュには列を追加する(既存のスナップショットはどのtargetにも一致しない)
+        columns = [row[1] for row in self.execute('PRAGMA table_info(sheet_snapshot)')]
+        if 'target' not in columns:
+            self.execute('ALTER TABLE sheet_snapshot ADD COLUMN target TEXT')
+        self.db.do_sql('DROP INDEX IF EXISTS idx_snapshot_sheet')
+        self.db.do_sql('CREATE INDEX IF NOT EXISTS idx_snapshot_target ON sheet_snapshot (sheet_id, worksheet, target)')
+        self.db.do_sql('CREATE INDEX IF NOT EXISTS idx_chunk_snapshot ON sheet_snapshot_chunk (snapshot_id, chunk_no)')
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            conn = self.db.get_conn()
+            with conn:
+                return conn.execute(sql, params).fetchall()
+
+    def get_latest(self, sheet_id, worksheet, target=''):
+        res = self.execute(
+            "SELECT id, revision, row_count, pulled_at FROM sheet_snapshot WHERE sheet_id = ? AND worksheet = ? AND target = ? AND status = 'done' ORDER BY id DESC LIMIT 1",
+            (sheet_id, worksheet, target))
+        if not res:
+            return None
+        return dict(zip(['id', 'revision', 'row_count', 'pulled_at'], res[0]))
+
+    def is_fresh(self, sheet_id, worksheet, revision, target=''):
+        u"""
+        同じtargetへの前回のロード時からシートが更新されていなければTrue(更新日時が取れない場合は常にFalse)
+        """
+        if not revision:
+            return False
+        latest = self.get_latest(sheet_id, worksheet, target)
+        return bool(latest) and latest['revision'] == revision
+
+    def begin(self, sheet_id, worksheet, revision, target=''):
+        now = dt.today().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            conn = self.db.get_conn()
+            with conn:
+                cursor = conn.execute(
+                    "INSERT INTO sheet_snapshot (sheet_id, worksheet, target, revision, row_count, status, pulled_at) VALUES (?, ?, ?, ?, 0, 'pulling', ?)",
+                    (sheet_id, worksheet, target, revision, now))
+                return Snapshot(self, cursor.lastrowid)
+
+    def append(self, snapshot_id, chunk_no, rows):
+        self.execute(
+            "INSERT INTO sheet_snapshot_chunk (snapshot_id, chunk_no, data) VALUES (?, ?, ?)",
+            (snapshot_id, chunk_no, json.dumps(rows, ensure_ascii=False)))
+
+    def commit(self, snapshot, row_count):
+        u"""
+        DBへのロードまで完了したスナップショットを有効にし、古いスナップショットを削除する
+        """
+        self.execute("UPDATE sheet_snapshot SET status = 'done', row_count = ? WHERE id = ?", (row_count, snapshot.id))
+        res = self.execute("SELECT sheet_id, worksheet, target FROM sheet_snapshot WHERE id = ?", (snapshot.id,))
+        self.evict(*res[0])
+
+    def iter_rows(self, sheet_id, worksheet, target=''):
+        u"""
+        最新のスナップショットの行をチャンク単位で返す
+        """
+        latest = self.get_latest(sheet_id, worksheet, target)
+        if not latest:
+            return
+        for (data,) in self.execute("SELECT data FROM sheet_snapshot_chunk WHERE snapshot_id = ? ORDER BY chunk_no", (latest['id'],)):
+            yield json.loads(data)
+
+    def evict(self, sheet_id, worksheet, target=''):
+        u"""
+        retention件より古いスナップショット・max_age_days日を過ぎたスナップショット・取得途中で終わったスナップショットを削除
+        """
+        limit = (dt.today() - timedelta(days=self.max_age_days)).strftime("%Y-%m-%d %H:%M:%S")
+        res = self.execute("SELECT id, status, pulled_at FROM sheet_snapshot WHERE sheet_id = ? AND worksheet = ? AND target = ? ORDER BY id DESC", (sheet_id, worksheet, target))
+        done = [row for row in res if row[1] == 'done']
+        keep = set([row[0] for row in done[:self.retention] if row[2] >= limit])
+        # 最新のスナップショットは期限切れでも残す(次回の更新確認に使う)
+        if done:
+            keep.add(done[0][0])
+        # 取得途中のものは直近の1件(実行中の可能性がある)のみ残す
+        if res and res[0][1] == 'pulling':
+            keep.add(res[0][0])
+        remove = [row[0] for row in res if row[0] not in keep]
+        for snapshot_id in remove:
+            self.execute("DELETE FROM sheet_snapshot_chunk WHERE snapshot_id = ?", (snapshot_id,))
+            self.execute("DELETE FROM sheet_snapshot WHERE id = ?", (snapshot_id,))
+        return len(remove)
@@ -0,0 +1,127 @@
+"""
+===============================================================================>
+
+Sheets APIクライアント(レート制限・リトライ)
+
+===============================================================================>
+"""
+import random
+import threading
+import time
+import metrics
+
+# リトライ対象のHTTPステータス(クォータ超過・サーバーエラー)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+"""
+トークンバケット
+rate件/秒でトークンを補充し、最大burst件まで連続で取り出せる
+"""
+class TokenBucket:
+
+    def __init__(self, rate=1.0, burst=10):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def get_status(e):
+    response = getattr(e, 'response', None)
+    if response is not None and getattr(response, 'status_code', None):
+        return response.status_code
+    return getattr(e, 'code', None)
+
+def is_retryable(e):
+    # requestsの通信エラーはOSErrorのサブクラス
+    return get_status(e) in RETRY_STATUS or isinstance(e, OSError)
+
+"""
+API呼び出しのリトライ設定
+"""
+class RetryPolicy:
+
+    def __init__(self, limiter=None, max_retries=5, base_delay=1.0, max_delay=64.0):
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+
+    def call(self, func, *args, **kwargs):
+        u"""
+        レート制限をかけて呼び出し、429・5xxはジッター付き指数バックオフでリトライする
+        """
+        for attempt in range(self.max_retries + 1):
+            if self.limiter:
+                self.limiter.acquire()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                self.retries += 1
+                metrics.incr('sheets_api_retries')
+                print('Sheets API retry({}/{}) after {:.1f} sec: {}'.format(attempt + 1, self.max_retries, delay, e))
+                time.sleep(delay)
+
+"""
+gspreadのClient・Spreadsheet・Worksheetのメソッド呼び出しをRetryPolicy経由にするラッパー
+"""
+class ApiProxy:
+
+    def __init__(self, target, policy):
+        self._target = target
+        self._policy = policy
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            return wrap_result(self._policy.call(attr, *args, **kwargs), self._policy)
+        return call
+
+def wrap_result(result, policy):
+    # Spreadsheet・Worksheetはラップして以降の呼び出しもレート制限の対象にする
+    if hasattr(result, 'worksheet') or hasattr(result, 'get_values'):
+        return ApiProxy(result, policy)
+    return result
+
+def get_policy(config=None):
+    config = config or {}
+    limiter = TokenBucket(float(config.get('rate', 1.0)), int(config.get('burst', 10)))
+    return RetryPolicy(limiter, int(config.get('max_retries', 5)), float(config.get('base_delay', 1.0)), float(config.get('max_delay', 64.0)))
+
+def wrap(client, config=None):
+    return ApiProxy(client, get_policy(config))
+
+def get_client(key_file, config=None):
+    u"""
+    認証済みのクライアントを返す。認証情報・クライアントはkey_file毎にキャッシュし、ジョブ間で共有する
+    """
+    with CLIENTS_LOCK:
+        if key_file not in CLIENTS:
+            import gspread
+            from oauth2client.service_account import ServiceAccountCredentials
+            policy = get_policy(config)
+            scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+            creds = ServiceAccountCredentials.from_json_keyfile_name(key_file, scope)
+            CLIENTS[key_file] = ApiProxy(policy.call(gspread.authorize, creds), policy)
+        return CLIENTS[key_file]
@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True)
+def work_dir(tmp_path, monkeypatch):
+    # ログ・キャッシュなどの相対パスのファイルは一時ディレクトリへ書き出す
+    import main
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(main.get_config(), 'LOG_FILE', str(tmp_path / 'log.txt'))
+    return tmp_path
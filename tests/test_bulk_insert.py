@@ -0,0 +1,210 @@
+import json
+import re
+from contextlib import contextmanager
+
+import pytest
+
+import db
+
+
+class StubError(Exception):
+    pass
+
+
+class StubCursor:
+    u"""
+    'BAD'を含む文は復旧可能なエラー、'BOOM'を含む文は復旧できないエラーにする
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def mogrify(self, placeholder, value):
+        return repr(tuple(value))
+
+    def execute(self, sql, args=None):
+        if 'BOOM' in sql:
+            raise RuntimeError('connection lost')
+        if 'BAD' in sql:
+            raise StubError('bad value')
+        self.conn.executed.append(sql)
+        return sql.count('),(') + 1
+
+    def fetchall(self):
+        return [{'Level': 'Warning', 'Code': 1062, 'Message': "Duplicate entry 'a' for key 'PRIMARY'"}]
+
+    def fetchmany(self, size):
+        return []
+
+    def close(self):
+        pass
+
+    def executemany(self, sql, args):
+        self.conn.quarantined.extend(args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class StubConnection:
+
+    def __init__(self):
+        self.executed = []
+        self.quarantined = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self, cursor_class=None):
+        return StubCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def get_db(monkeypatch, quarantine='table', path=None):
+    conn = StubConnection()
+    target = db.MariaDB({'host': 'localhost', 'port': 3306, 'db': 'test_db', 'user': 'root', 'pass': ''})
+    target.set_load_config({'batch_rows': 2, 'commit_batches': 10, 'recovery': 'bisect', 'quarantine': quarantine, 'quarantine_file': path})
+
+    @contextmanager
+    def get_connection():
+        yield conn
+    monkeypatch.setattr(target, 'get_connection', get_connection)
+    monkeypatch.setattr(db, 'get_recoverable_errors', lambda: (StubError,))
+    return target, conn
+
+
+def test_bisect_quarantines_bad_row(monkeypatch):
+    target, conn = get_db(monkeypatch)
+    result = target.bulk_insert('t', ['name'], [('a',), ('BAD',), ('c',), ('d',)])
+    assert (result['rows'], result['rejected']) == (3, 1)
+    assert [json.loads(row[0]) for row in conn.quarantined] == [['BAD']]
+    assert [sql for sql in conn.executed if sql.startswith('INSERT')] == ["INSERT INTO test_db.t (name) VALUES ('a',)", "INSERT INTO test_db.t (name) VALUES ('c',),('d',)"]
+
+
+def test_rejected_rows_are_quarantined_before_failure(monkeypatch):
+    target, conn = get_db(monkeypatch)
+    with pytest.raises(db.BulkInsertError) as e:
+        target.bulk_insert('t', ['name'], [('a',), ('BAD',), ('c',), ('d',), ('BOOM',), ('f',)])
+    # 'BAD'は処理済み(rows)に含まれ再実行されないため、失敗時にも隔離されている
+    assert e.value.rows == 4
+    assert [json.loads(row[0]) for row in conn.quarantined] == [['BAD']]
+    assert conn.commits == 1
+
+
+def test_quarantine_file(monkeypatch, tmp_path):
+    path = str(tmp_path / 'rejected.jsonl')
+    target, conn = get_db(monkeypatch, 'file', path)
+    with pytest.raises(db.BulkInsertError):
+        target.bulk_insert('t', ['name'], [('BAD',), ('c',), ('BOOM',)])
+    with open(path, encoding='utf-8') as f:
+        rows = [json.loads(line) for line in f]
+    assert [(row['table'], row['row']) for row in rows] == [('t', ['BAD'])]
+
+
+def test_infile_with_skipped_rows_falls_back_to_insert(monkeypatch):
+    # LOAD DATA LOCALで読み飛ばされた行があればロールバックし、そのバッチはINSERTで入れ直す
+    target, conn = get_db(monkeypatch)
+    target.set_load_config({'mode': 'infile'})
+    target.local_infile = True
+    msg = target.load('t', ['name'], [('a',), ('b',), ('c',)])
+    assert conn.rollbacks == 1
+    assert [sql for sql in conn.executed if sql.startswith('SHOW WARNINGS')] == ['SHOW WARNINGS LIMIT 5']
+    assert msg == 'BULK INSERT Results:3 Rejected:0'
+    with pytest.raises(db.LoadError, match="1/3 rows.*Duplicate entry"):
+        target.load_data_infile('t', ['name'], [('a',), ('b',), ('c',)])
+
+
+def test_iter_fetch_raises_net_write_timeout(monkeypatch):
+    # 読み手が遅くても切断されないようにセッションのnet_write_timeoutを延ばし、終わったら戻す
+    target, conn = get_db(monkeypatch)
+    target.set_load_config({'net_write_timeout': 900})
+    assert list(target.iter_fetch('SELECT 1')) == []
+    assert conn.executed == ['SET SESSION net_write_timeout = 900', 'SELECT 1', 'SET SESSION net_write_timeout = DEFAULT']
+
+
+def get_pooled_db(monkeypatch, size=5, parallel=4):
+    pool = db.ConnectionPool({}, size=size, ping=False, timeout=0)
+    conns = []
+    def new_connection():
+        conns.append(StubConnection())
+        return conns[-1]
+    pool.new_connection = new_connection
+    target = db.MariaDB({'host': 'localhost', 'port': 3306, 'db': 'test_db', 'user': 'root', 'pass': ''})
+    target.set_load_config({'batch_rows': 2, 'parallel': parallel, 'partition_key': ['name']})
+    monkeypatch.setattr(target, 'get_pool', lambda: pool)
+    monkeypatch.setattr(db, 'get_recoverable_errors', lambda: (StubError,))
+    return target, pool, conns
+
+
+def test_parallel_insert_keeps_key_order(monkeypatch):
+    target, pool, conns = get_pooled_db(monkeypatch)
+    rows = [('k{}'.format(i % 3), i) for i in range(30)]
+    result = target.parallel_insert('t', ['name', 'value'], rows)
+    assert (result['rows'], result['errors']) == (30, [])
+    placed = {}
+    for i, conn in enumerate(conns):
+        for sql in conn.executed:
+            for name, value in re.findall(r"\('(k\d)', (\d+)\)", sql):
+                placed.setdefault(name, []).append((i, int(value)))
+    for name, values in placed.items():
+        assert len(set([i for i, value in values])) == 1
+        assert [value for i, value in values] == sorted([value for i, value in values])
+    assert pool.available() == 5
+
+
+def test_parallel_is_bounded_by_free_connections(monkeypatch):
+    target, pool, conns = get_pooled_db(monkeypatch, size=5, parallel=4)
+    assert target.get_parallel() == 4
+    held = [pool.acquire() for i in range(3)]
+    assert target.get_parallel() == 2
+    held.append(pool.acquire())
+    assert target.get_parallel() == 1
+    for conn in held:
+        pool.release(conn)
+
+
+def test_pool_timeout_is_reported_per_partition(monkeypatch):
+    target, pool, conns = get_pooled_db(monkeypatch, size=3, parallel=3)
+    acquire = pool.acquire
+    calls = []
+    def flaky_acquire():
+        calls.append(1)
+        if len(calls) == 2:
+            raise db.PoolTimeout('no free connection')
+        return acquire()
+    pool.acquire = flaky_acquire
+    rows = [('k{}'.format(i), i) for i in range(30)]
+    result = target.parallel_insert('t', ['name', 'value'], rows)
+    assert len(result['errors']) == 1
+    assert 'PoolTimeout' in result['errors'][0]['error']
+    assert result['rows'] == 30 - result['errors'][0]['rows']
+    with pytest.raises(db.LoadError):
+        db.check_parallel_result('t', result)
+
+
+def test_delta_sync_skips_state_of_rejected_rows(monkeypatch):
+    import fakesheet
+    import main
+    target, conn = get_db(monkeypatch)
+    monkeypatch.setattr(target, 'do_sql', lambda sql: 0)
+    monkeypatch.setattr(target, 'migrate_table', lambda table, with_index=True: None)
+    monkeypatch.setattr(target, 'fetch_all', lambda sql: [])
+    config = main.get_config()
+    spreadsheet = dict(config['spreadsheet'], transform='python')
+    rows = [['name', 'email'], ['a', 'a@example.com'], ['BAD', 'b@example.com'], ['c', 'c@example.com']]
+    client = fakesheet.FakeClient({spreadsheet['id']: {spreadsheet['name']: rows}})
+    job = {'name': 'test', 'spreadsheet': spreadsheet, 'table': dict(config['table'], defer_index=False), 'load': {'sync': 'delta'}}
+    sheet = main.SpreadSheet(None, False, True, client, job, target)
+    result = sheet.sync_delta(target, ['name', 'email', 'created'], sheet.get_insert_list(sheet.get_data(), ['name', 'email'], '2024-01-01 00:00:00'))
+    assert result == 'DELTA Results: inserted:2 updated:0 deleted:0 unchanged:0 rejected:1'
+    assert [json.loads(row[0])[0] for row in conn.quarantined] == ['BAD']
+    # 隔離した行のキーは状態テーブルに書き込まない(次回も再反映する)
+    state_sql = [sql for sql in conn.executed if 'test_table__sync_state' in sql and sql.startswith('INSERT')]
+    assert len(state_sql) == 1 and '"a"' in state_sql[0] and '"c"' in state_sql[0] and 'BAD' not in state_sql[0]
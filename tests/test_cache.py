@@ -0,0 +1,50 @@
+import db
+import fakesheet
+import main
+import sheetcache
+
+ROWS = [['name', 'email']] + [['user{}'.format(i), 'user{}@example.com'.format(i)] for i in range(12)]
+
+
+def get_sheet(client, table_name, target, pair=None):
+    config = main.get_config()
+    spreadsheet = dict(config['spreadsheet'], transform='python')
+    if pair:
+        spreadsheet['pair'] = pair
+    table = dict(config['table'], name=table_name, defer_index=False)
+    job = {'name': table_name, 'spreadsheet': spreadsheet, 'table': table, 'load': {'sync': 'full'}}
+    return main.SpreadSheet(None, False, True, client, job, target)
+
+
+def count(target, table_name):
+    return target.fetch_one('SELECT COUNT(*) FROM ' + table_name)[0]
+
+
+def test_cache_is_keyed_by_target(work_dir):
+    config = main.get_config()
+    client = fakesheet.FakeClient({config['spreadsheet']['id']: {config['spreadsheet']['name']: ROWS}})
+    cache = sheetcache.SheetCache({'db_file': 'cache.db', 'exec_dir': str(work_dir)})
+    target = db.SQLite({'name': 'test_table', 'db_file': 'test.db'}, str(work_dir))
+    assert main.sync_sheet(get_sheet(client, 'table_a', target), 'test_db', cache) == 12
+    # 同じワークシートを別のテーブルへロードするジョブはスキップしない
+    assert main.sync_sheet(get_sheet(client, 'table_b', target), 'test_db', cache) == 12
+    assert count(target, 'table_b') == 12
+    # 同じロード先で更新がなければスキップする
+    assert main.sync_sheet(get_sheet(client, 'table_a', target), 'test_db', cache) == 0
+    # 列の対応を変えたら再取得する
+    pair = [{'idx': '1', 'col': 'name'}, {'idx': '0', 'col': 'email'}]
+    assert main.sync_sheet(get_sheet(client, 'table_a', target, pair), 'test_db', cache) == 12
+    target.close()
+
+
+def test_old_cache_gets_target_column(work_dir):
+    conn = db.SQLite({'name': 'sheet_snapshot', 'db_file': 'old.db'}, str(work_dir)).get_conn()
+    conn.execute('CREATE TABLE sheet_snapshot (id INTEGER PRIMARY KEY AUTOINCREMENT, sheet_id TEXT, worksheet TEXT, revision TEXT, row_count INTEGER, status TEXT, pulled_at DATETIME)')
+    conn.execute("INSERT INTO sheet_snapshot (sheet_id, worksheet, revision, row_count, status, pulled_at) VALUES ('s', 'w', 'r1', 1, 'done', '2024-01-01 00:00:00')")
+    conn.commit()
+    conn.close()
+    cache = sheetcache.SheetCache({'db_file': 'old.db', 'exec_dir': str(work_dir)})
+    assert not cache.is_fresh('s', 'w', 'r1', 'test_db.t#x')
+    snapshot = cache.begin('s', 'w', 'r1', 'test_db.t#x')
+    cache.commit(snapshot, 1)
+    assert cache.is_fresh('s', 'w', 'r1', 'test_db.t#x')
@@ -0,0 +1,113 @@
+from contextlib import contextmanager
+
+import pytest
+
+import db
+import fakesheet
+import main
+
+SHEET = [['name', 'email'], ['a', 'a@example.com'], ['b', 'b@example.com'], ['c', 'c@example.com']]
+
+
+class StubDB:
+    u"""
+    実行したSQL・操作を記録するMariaDBの代替。failがTrueならloadでLoadErrorを送出する
+    """
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+
+    def do_sql(self, sql):
+        self.calls.append(('do_sql', sql))
+        return 0
+
+    def migrate_table(self, table, with_index=True):
+        self.calls.append(('migrate_table', table['name']))
+        return None
+
+    def drop_table(self, table):
+        self.calls.append(('drop_table', table))
+
+    def with_scheme(self, table):
+        return 'test_db.' + table
+
+    @contextmanager
+    def session(self, **variables):
+        yield None
+
+    def load(self, table, col_list, value_list):
+        self.calls.append(('load', table, len(value_list)))
+        if self.fail:
+            raise db.LoadError(table, 1, len(value_list), 'boom')
+        return 'BULK INSERT Results:{}'.format(len(value_list))
+
+    def swap_table(self, table, new_table, old_table):
+        self.calls.append(('swap_table', table, new_table))
+
+
+def get_sheet(target, sync='swap'):
+    config = main.get_config()
+    spreadsheet = dict(config['spreadsheet'], transform='python')
+    client = fakesheet.FakeClient({spreadsheet['id']: {spreadsheet['name']: SHEET}})
+    job = {'name': 'test', 'spreadsheet': spreadsheet, 'table': dict(config['table'], defer_index=False), 'load': {'sync': sync}}
+    return main.SpreadSheet(None, False, True, client, job, target)
+
+
+def test_swap_load_failure_keeps_live_table():
+    target = StubDB(fail=True)
+    sheet = get_sheet(target)
+    with pytest.raises(db.LoadError):
+        sheet.insert_batches(sheet.iter_batches(), 'test_db')
+    names = [call[0] for call in target.calls]
+    assert 'swap_table' not in names
+    assert not [call for call in target.calls if call[0] == 'do_sql' and call[1].startswith('ALTER TABLE')]
+    assert target.calls[-1] == ('drop_table', 'test_db.test_table__staging')
+
+
+def test_swap_load_success_swaps_table():
+    target = StubDB()
+    sheet = get_sheet(target)
+    assert sheet.insert_batches(sheet.iter_batches(), 'test_db') == 3
+    assert ('swap_table', 'test_table', 'test_table__staging') in target.calls
+    # 稼働中のテーブルはALTER TABLEしない
+    assert ('migrate_table', 'test_table') not in target.calls
+
+
+def test_check_parallel_result_raises_on_unrecovered_partition():
+    recovered = {'rows': 10, 'errors': [{'partition': 0, 'rows': 5, 'loaded': 5, 'error': 'x'}]}
+    assert db.check_parallel_result('t', recovered) is recovered
+    failed = {'rows': 8, 'errors': [{'partition': 1, 'rows': 5, 'loaded': 3, 'error': 'y'}]}
+    with pytest.raises(db.LoadError) as e:
+        db.check_parallel_result('t', failed)
+    assert (e.value.rows, e.value.total) == (8, 10)
+
+
+def test_delta_sync_rejects_sqlite(work_dir):
+    target = db.SQLite({'name': 'test_table', 'db_file': 'test.db'}, str(work_dir))
+    sheet = get_sheet(target, sync='delta')
+    with pytest.raises(ValueError):
+        sheet.insert_batches(sheet.iter_batches(), 'test_db')
+    target.close()
+
+
+class DeltaDB(StubDB):
+
+    def create_table(self, table):
+        pass
+
+    def fetch_all(self, sql):
+        return []
+
+    def bulk_insert(self, table, col_list, value_list, update_cols=None):
+        self.calls.append(('bulk_insert', table, list(col_list), update_cols))
+        return {'rows': len(value_list)}
+
+
+def test_delta_sync_keeps_created():
+    target = DeltaDB()
+    sheet = get_sheet(target, sync='delta')
+    sheet.insert_batches(sheet.iter_batches(), 'test_db')
+    upsert = [call for call in target.calls if call[0] == 'bulk_insert' and call[1] == 'test_table'][0]
+    assert upsert[2] == ['name', 'email', 'created']
+    assert upsert[3] == ['email']
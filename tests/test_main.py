@@ -0,0 +1,122 @@
+import os
+import subprocess
+import sys
+import threading
+
+import bench
+import export
+import fakesheet
+import main
+import myutil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROWS = [['name', 'email']] + [['user{}'.format(i), 'user{}@example.com'.format(i)] for i in range(25)]
+
+
+def get_client(rows=ROWS):
+    config = main.get_config()
+    return fakesheet.FakeClient({config['spreadsheet']['id']: {config['spreadsheet']['name']: rows}})
+
+
+def get_sheet(client, insert_mode=True, **spreadsheet):
+    config = main.get_config()
+    job = {'name': 'test', 'spreadsheet': dict(config['spreadsheet'], transform='python', **spreadsheet)}
+    return main.SpreadSheet(None, False, insert_mode, client, job)
+
+
+def test_import_time_has_no_heavy_modules():
+    # main・main.py --helpではpandas・pymysqlなどを読み込まない(python -X importtimeで確認)
+    for res in bench.bench_imports():
+        assert res['returncode'] == 0, res['name']
+        assert res['heavy'] == [], res['name']
+
+
+def test_dry_run_does_not_connect(work_dir):
+    # insert_modeがFalseならpymysqlを読み込まず、DBへ接続しない
+    script = (
+        "import sys, main, fakesheet\n"
+        "config = main.get_config()\n"
+        "config['LOG_FILE'] = sys.argv[1]\n"
+        "client = fakesheet.FakeClient({config['spreadsheet']['id']: {config['spreadsheet']['name']: [['name', 'email'], ['a', 'a@example.com']]}})\n"
+        "sheet = main.SpreadSheet(None, False, False, client, {'spreadsheet': dict(config['spreadsheet'], transform='python')})\n"
+        "print(main.sync_sheet(sheet, 'test_db'), 'pymysql' in sys.modules)\n"
+    )
+    proc = subprocess.run([sys.executable, '-c', script, str(work_dir / 'log.txt')], cwd=ROOT, capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
+    assert proc.stdout.split()[-2:] == ['1', 'False']
+
+
+def test_reader_batches_ranges():
+    client = get_client()
+    sheet = get_sheet(client, batch_rows=10, ranges_per_request=2)
+    batches = list(sheet.iter_data())
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+    assert batches[0][0] == {'name': 'user0', 'email': 'user0@example.com'}
+    worksheet = client.open_by_key(sheet.sheet_key).worksheet(sheet.spreadsheet['name'])
+    # 2範囲ずつbatchGet、残りの1範囲はget_valuesで取得する
+    assert [call for call in worksheet.calls if call[0] == 'batch_get'] == [('batch_get', ['A2:B11', 'A12:B21'])]
+    assert worksheet.calls[-1] == ('get_values', 'A22:B26')
+
+
+def test_reader_get_data():
+    sheet = get_sheet(get_client())
+    assert len(sheet.get_data()) == 25
+
+
+class StubDB:
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def iter_fetch(self, sql, fetch_size=None, net_write_timeout=None):
+        return iter(self.rows)
+
+
+def test_export_writes_changed_rows_only():
+    worksheet = fakesheet.FakeWorksheet('export')
+    rows = [{'id': i, 'name': 'user{}'.format(i)} for i in range(5)]
+    result = export.export_query(StubDB(rows), 'SELECT', worksheet, batch_rows=2)
+    assert (result['rows'], result['written_rows']) == (5, 6)
+    assert worksheet.get_all_values() == [['id', 'name']] + [[str(i), 'user{}'.format(i)] for i in range(5)]
+    # 変更がなければ書き込まない。減った行は消す
+    rows[1]['name'] = 'changed'
+    result = export.export_query(StubDB(rows[:4]), 'SELECT', worksheet, batch_rows=2)
+    assert result['written_rows'] == 1
+    assert worksheet.get_values('A1:B6') == [['id', 'name'], ['0', 'user0'], ['1', 'changed'], ['2', 'user2'], ['3', 'user3']]
+
+
+def test_export_data(monkeypatch):
+    config = main.get_config()['export']
+    client = fakesheet.FakeClient({config['spreadsheet_id']: {config['worksheet']: []}})
+    monkeypatch.setattr(main, 'get_db', lambda db_name, load_config=None: StubDB([{'id': 1, 'name': 'a'}]))
+    assert main.export_data('test_db', client)['rows'] == 1
+    assert client.open_by_key(config['spreadsheet_id']).worksheet(config['worksheet']).get_all_values() == [['id', 'name'], ['1', 'a']]
+
+
+def test_flush_log_survives_write_error(tmp_path, capsys):
+    # 書き込めないログファイルでもLogWriterは止まらず、flush_logが返る
+    log_file = str(tmp_path / 'missing' / 'log.txt')
+    myutil.output_log(log_file, 'x')
+    flusher = threading.Thread(target=myutil.flush_log, args=(log_file,), daemon=True)
+    flusher.start()
+    flusher.join(5)
+    assert not flusher.is_alive()
+    assert 'log write failed' in capsys.readouterr().err
+    myutil.output_log(log_file, 'y')
+    myutil.flush_log(log_file)
+
+
+def test_prefetch_stops_when_consumer_stops():
+    # 処理側が途中でやめたら先読みスレッドも止まり、元のiterableがcloseされる
+    closed = threading.Event()
+    def source():
+        try:
+            for i in range(100):
+                yield i
+        finally:
+            closed.set()
+    items = myutil.prefetch(source())
+    assert next(items) == 0
+    items.close()
+    assert closed.wait(5)
+    assert list(myutil.prefetch(range(3))) == [0, 1, 2]
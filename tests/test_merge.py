@@ -0,0 +1,60 @@
+import db
+
+
+class StubResult:
+
+    def __init__(self, message):
+        self.message = message
+
+
+class StubCursor:
+
+    def __init__(self, message):
+        self._result = StubResult(message)
+
+
+def test_get_info():
+    assert db.get_info(StubCursor(b'&Records: 3  Duplicates: 1  Warnings: 0')) == {'records': 3, 'duplicates': 1}
+    assert db.get_info(StubCursor(b'')) is None
+    assert db.get_info(object()) is None
+
+
+def test_count_changes_update():
+    # 追加1・更新1・変更なし1: 影響行数は1+2+0、Duplicatesは実際に更新した行のみ
+    assert db.count_changes('update', 3, 3, {'records': 3, 'duplicates': 1}) == {'inserted': 1, 'updated': 1, 'unchanged': 1}
+    assert db.count_changes('update', 3, 0, {'records': 3, 'duplicates': 0}) == {'inserted': 0, 'updated': 0, 'unchanged': 3}
+    assert db.count_changes('update', 2, 4, {'records': 2, 'duplicates': 2}) == {'inserted': 0, 'updated': 2, 'unchanged': 0}
+
+
+def test_count_changes_update_single_row():
+    # 1行の文には情報がないため影響行数だけで判定する
+    assert db.count_changes('update', 1, 1) == {'inserted': 1, 'updated': 0, 'unchanged': 0}
+    assert db.count_changes('update', 1, 2) == {'inserted': 0, 'updated': 1, 'unchanged': 0}
+    assert db.count_changes('update', 1, 0) == {'inserted': 0, 'updated': 0, 'unchanged': 1}
+
+
+def test_count_changes_ignore_and_replace():
+    assert db.count_changes('ignore', 5, 3, {'records': 5, 'duplicates': 2}) == {'inserted': 3, 'updated': 0, 'unchanged': 2}
+    assert db.count_changes('replace', 5, 7, {'records': 5, 'duplicates': 2}) == {'inserted': 3, 'updated': 2, 'unchanged': 0}
+    assert db.count_changes('replace', 5, 7) == {'inserted': 3, 'updated': 2, 'unchanged': 0}
+
+
+def test_sql_for_strategies():
+    target = db.MariaDB({'host': 'localhost', 'port': 3306, 'db': 'test_db', 'user': 'root', 'pass': ''})
+    literals = ["('a', 1)", "('b', 2)"]
+    assert target.get_sql_for_bulk_insert('t', ['k', 'v'], literals, ['v'], 'update') == \
+        "INSERT INTO test_db.t (k, v) VALUES ('a', 1),('b', 2) ON DUPLICATE KEY UPDATE v = VALUES(v)"
+    assert target.get_sql_for_bulk_insert('t', ['k', 'v'], literals, [], 'update') == \
+        "INSERT INTO test_db.t (k, v) VALUES ('a', 1),('b', 2) ON DUPLICATE KEY UPDATE k = k"
+    assert target.get_sql_for_bulk_insert('t', ['k', 'v'], literals, None, 'ignore').startswith('INSERT IGNORE INTO test_db.t ')
+    assert target.get_sql_for_bulk_insert('t', ['k', 'v'], literals, None, 'replace').startswith('REPLACE INTO test_db.t ')
+
+
+def test_merge_update_cols_default():
+    # update_colsがNoneならキーとcreated以外を更新し、空なら何も更新しない
+    target = db.MariaDB({'host': 'localhost', 'port': 3306, 'db': 'test_db', 'user': 'root', 'pass': ''})
+    calls = []
+    target.bulk_insert = lambda table, col_list, value_list, update_cols=None, strategy=None: calls.append(update_cols)
+    target.merge('t', ['k', 'v', 'created'], [('a', 1, 'x')], 'update', ['k'])
+    target.merge('t', ['k', 'v', 'created'], [('a', 1, 'x')], 'update', ['k'], [])
+    assert calls == [['v'], []]
@@ -0,0 +1,47 @@
+import pytest
+
+import db
+
+
+class StubConnection:
+
+    def __init__(self):
+        self.rollbacks = 0
+        self.closed = False
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+def get_pool(size=2):
+    pool = db.ConnectionPool({}, size=size, recycle=0, ping=False, timeout=0)
+    pool.new_connection = StubConnection
+    return pool
+
+
+def test_release_always_rolls_back():
+    # 参照だけの接続もトランザクションを終わらせてから返却する
+    pool = get_pool()
+    conn = pool.acquire()
+    pool.release(conn)
+    assert conn.rollbacks == 1
+    assert pool.acquire() is conn
+
+
+def test_connections_are_reused_and_bounded():
+    pool = get_pool(size=2)
+    first = pool.acquire()
+    second = pool.acquire()
+    assert pool.available() == 0
+    with pytest.raises(db.PoolTimeout):
+        pool.acquire()
+    pool.release(first)
+    assert pool.available() == 1
+    assert pool.acquire() is first
+    pool.release(first)
+    pool.release(second)
+    pool.close()
+    assert first.closed and second.closed
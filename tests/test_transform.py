@@ -0,0 +1,54 @@
+import time
+
+import pandas as pd
+import pytest
+
+import myutil
+import transform
+
+
+def test_coerce_datetime_with_mixed_timezones():
+    series = pd.Series(['2024-01-05T10:00:00Z', '2024-01-06 10:00:00', '2024-01-07T10:00:00+09:00', '', 'x'])
+    assert transform.coerce(series, 'datetime').tolist()[:3] == ['2024-01-05 10:00:00', '2024-01-06 10:00:00', '2024-01-07 01:00:00']
+    assert transform.coerce(series, 'date').tolist()[:3] == ['2024-01-05', '2024-01-06', '2024-01-07']
+    assert transform.coerce(series, 'datetime')[3:].isna().all()
+
+
+def test_coerce_datetime_with_mixed_formats():
+    series = pd.Series(['2024/01/05 10:00', '2024-01-06'])
+    assert transform.coerce(series, 'datetime').tolist() == ['2024-01-05 10:00:00', '2024-01-06 00:00:00']
+
+
+VALUES = ['2024-01-05 10:00:00', '2024-01-05T10:00:00Z', '2024-01-05T19:00:00+09:00', '2024/01/05 10:00:00', '2024/01/06 23:30', '2024-01-07', '', 'x']
+
+
+def get_row_result(name):
+    return myutil.apply_row_transforms([name], VALUES)
+
+
+def get_column_result(name):
+    res = transform.apply_transforms(pd.Series(VALUES), [name])
+    return [None if pd.isna(value) else value for value in res.tolist()]
+
+
+@pytest.mark.parametrize('name', ['utc_to_jst', 'week_start', 'strip'])
+def test_row_and_column_transforms_match(name, monkeypatch):
+    # タイムゾーンなしの値はホストのタイムゾーンによらずUTCとみなす
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    try:
+        assert get_row_result(name) == get_column_result(name)
+    finally:
+        monkeypatch.delenv('TZ')
+        time.tzset()
+
+
+def test_utc_to_jst():
+    assert get_row_result('utc_to_jst')[:4] == ['2024-01-05 19:00:00'] * 4
+    assert get_row_result('week_start')[:6] == ['2023-12-31'] * 5 + ['2024-01-07']
+
+
+def test_coerce_int_invalid_values_are_null():
+    assert transform.coerce(pd.Series(['1', '2.5', '', '3.0', '1,000']), 'int(11)').tolist() == [1, pd.NA, pd.NA, 3, 1000]
+    assert transform.coerce(pd.Series(['99999999999999999999']), 'int(11)').tolist() == [pd.NA]
+    assert transform.coerce(pd.Series(['18446744073709551615', '9223372036854775807']), 'bigint').tolist() == [pd.NA, 9223372036854775807]
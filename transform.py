@@ -0,0 +1,120 @@
+"""
+===============================================================================>
+
+シートデータの列単位変換(pandas)
+
+===============================================================================>
+"""
+import warnings
+import pandas as pd
+import myutil
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def get_column_types(table):
+    return {col['name']: col['type'].lower() for col in table['columns']}
+
+def coerce(series, col_type):
+    u"""
+    テーブル定義の型に合わせて列をまとめて変換する。変換できない値・空文字はNULL(型付き列のみ)
+    """
+    if 'int' in col_type:
+        return to_int(series)
+    if any([t in col_type for t in ('decimal', 'float', 'double')]):
+        return pd.to_numeric(series.str.replace(',', ''), errors='coerce')
+    if 'datetime' in col_type or 'timestamp' in col_type:
+        return to_datetime(series).dt.strftime(DATETIME_FORMAT)
+    if 'date' in col_type:
+        return to_datetime(series).dt.strftime(DATE_FORMAT)
+    return series
+
+def to_int(series):
+    u"""
+    整数に変換する。小数部のある値・int64の範囲外の値はNULL
+    """
+    num = pd.to_numeric(series.str.replace(',', ''), errors='coerce')
+    if num.dtype.kind == 'i':
+        return num.astype('Int64')
+    valid = (num % 1 == 0) & (num >= -2**63) & (num < 2**63)
+    if num.dtype.kind == 'u':
+        # uint64はfloatにすると桁が落ちるため、Pythonの整数のまま変換する
+        return num.astype(object).where(valid, None).astype('Int64')
+    return num.where(valid).astype('Int64')
+
+def to_datetime(series):
+    u"""
+    先頭の値から推定した書式でまとめて変換し、変換できなかった値だけ書式混在として再変換する
+    タイムゾーン付きの値はUTCに揃えてからタイムゾーンを外す(タイムゾーンなしの値はUTCとみなす。utc_to_jstと同じ)
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        parsed = pd.to_datetime(series, errors='coerce', utc=True)
+    retry = parsed.isna() & (series != '')
+    if retry.any():
+        parsed = parsed.mask(retry, pd.to_datetime(series[retry], errors='coerce', format='mixed', utc=True))
+    return parsed.dt.tz_convert(None)
+
+def utc_to_jst(series):
+    parsed = to_datetime(series).dt.tz_localize('UTC')
+    # タイムゾーン付きのままstrftimeすると遅いため、JSTに変換してからタイムゾーンを外す
+    return parsed.dt.tz_convert(myutil.get_tz('Asia/Tokyo')).dt.tz_localize(None).dt.strftime(DATETIME_FORMAT)
+
+def week_start(series):
+    # その週の日曜日(myutil.get_sunday_of_the_weekと同じ)
+    parsed = to_datetime(series).dt.normalize()
+    return (parsed - pd.to_timedelta((parsed.dt.weekday + 1) % 7, unit='D')).dt.strftime(DATE_FORMAT)
+
+def strip(series):
+    return series.str.strip()
+
+# config.jsonのpairで列毎に指定できる変換(列単位)。ここにない変換はmyutil.ROW_TRANSFORMSで行単位に変換する
+COLUMN_TRANSFORMS = {
+    'utc_to_jst': utc_to_jst,
+    'week_start': week_start,
+    'strip': strip,
+}
+
+def apply_transforms(series, names, workers=0, chunk_rows=10000):
+    u"""
+    列に変換を順に適用する。列単位の実装がない変換はmyutil.map_column_transformsで(必要ならプロセスプールで)変換する
+    """
+    if not names:
+        return series
+    empty = series.isna() | (series == '')
+    for name in names:
+        if name in COLUMN_TRANSFORMS:
+            series = COLUMN_TRANSFORMS[name](series)
+            continue
+        values = myutil.map_column_transforms({'values': series.tolist()}, {'values': [name]}, workers, chunk_rows)['values']
+        series = pd.Series(values, index=series.index, dtype=object)
+    # 行単位の変換(myutil.apply_row_transforms)と同じく空の値はNULLにする
+    return series.mask(empty, None)
+
+def to_frame(rows, pair, table, workers=0, chunk_rows=10000):
+    u"""
+    シートの行(二次元リスト)をpairの列名・テーブル定義の型を持つDataFrameに変換する
+    pairのtransformに指定した変換は型変換の前に行う
+    """
+    col_types = get_column_types(table)
+    matrix = pd.DataFrame(rows, dtype=str)
+    data = {}
+    for info in pair:
+        idx = int(info['idx'])
+        series = matrix[idx] if idx in matrix.columns else pd.Series([''] * len(matrix), dtype=str)
+        series = apply_transforms(series, myutil.get_transform_names(info.get('transform')), workers, chunk_rows)
+        data[info['col']] = coerce(series, col_types.get(info['col'], 'text'))
+    return pd.DataFrame(data)
+
+def column_values(series):
+    values = series.tolist()
+    if series.hasnans:
+        return [None if pd.isna(v) else v for v in values]
+    return values
+
+def to_rows(df):
+    u"""
+    DataFrameをバルクロード用の行(tuple)のリストに変換(欠損値はNone)
+    """
+    return list(zip(*[column_values(df[col]) for col in df.columns]))